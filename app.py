@@ -1,241 +1,273 @@
+from warmup import WARMUP_DEFAULT, BackgroundWarmUp, startup_timer
 import streamlit as st
-import ollama
-import easyocr
-from PIL import Image
-import numpy as np
-import io
+import os
+import time
 from datetime import datetime
-import cv2
+from pathlib import Path
+from ocr_cache import OCRCache
+from ocr_engine import OCR_WORKERS, OCRJob, get_reader, ocr_settings, reader_loaded, run_ocr_jobs
+from result_cache import ResultCache
+from retrieval import KnowledgeIndex
+from prompting import RETRIEVAL_TOP_K, format_prompt_stats
+from history_store import HISTORY_PAGE_SIZE, HistoryStore
+from git_ingest import GIT_TAGS, GIT_TICKET_PREFIXES, GitCheckpoints, GitIngestError, read_repository, split_list
+from jobs import ACTIVE_STATUSES, BACKGROUND_JOBS_DEFAULT, EndpointPool, JobQueue, JobRequest
+from metrics import METRICS_PORT, RequestMetrics, format_metrics, record_request, start_metrics_server
+from narrative import (
+    OLLAMA_CONCURRENCY,
+    NarrativeGenerationError,
+    NarrativeGenerator,
+    NarrativeStreamParser,
+    format_narrative_output,
+    parallel_requests,
+)
+
+# EasyOCR/PyTorch are not imported yet; they load with the first image or the warm-up thread
+startup_timer.mark("app imports")
+
+# Minimum seconds between UI redraws while a narrative is streaming
+STREAM_RENDER_INTERVAL = 0.15
+# Seconds between status polls of a running background job
+JOB_POLL_INTERVAL = 1.0
 
 # --- MODEL LOADING (CACHED) ---
 
 @st.cache_resource
-def load_ocr_reader():
-    """Loads the EasyOCR reader object once and caches it."""
-    print("Loading EasyOCR reader...")
-    reader = easyocr.Reader(['en'])
-    print("Reader loaded.")
-    return reader
+def start_background_warm_up() -> BackgroundWarmUp:
+    """Starts preloading the OCR reader, and the model on every Ollama endpoint in the pool, once per process."""
+    warm_up = BackgroundWarmUp({endpoint.host: NarrativeGenerator(host=endpoint.url) for endpoint in load_job_queue().pool.endpoints})
+    warm_up.start()
+    return warm_up
 
-def generate_narrative_local(extracted_text: str) -> str:
-    """
-    Generates the SR&ED narrative using the local Ollama model.
-    Uses knowledge base-informed prompting with process entity models and Q&A patterns.
-    """
-    # Knowledge Base-Informed Prompting (Enhanced from user-provided corpus)
-    knowledge_base_context = """
-=== SR&ED KNOWLEDGE BASE CONTEXT ===
-
-CORE SR&ED CONCEPTS (The 5 Questions):
-1. Was there a scientific or technological uncertainty? (Not business uncertainty - must be technical)
-2. Did it involve formulating hypotheses? (Specific, testable technical statements, not business goals)
-3. Was the approach systematic? (Testing, analysis, experiments, not routine work)
-4. Was the goal technological advancement? (Advancing the field, not just the product)
-5. Were records/documentation kept? (Contemporaneous evidence is critical)
-
-KEY DISTINCTIONS TO GET RIGHT:
-- Business Goal ("We will make the software faster") ≠ SR&ED Hypothesis ("Algorithm X will reduce latency by overcoming the bottleneck")
-- Business Project (overall commercial goal) ≠ SR&ED Project (focused sub-project addressing specific technical uncertainty)
-- Routine engineering (standard practice, ineligible) ≠ Experimental development (novel approach, eligible)
-- Product advancement (user-facing improvements) ≠ Technological advancement (new knowledge, underlying tech)
-- Failed project (ineligible if no real experimentation) ≠ Failed experiment (eligible - proves a hypothesis wrong)
-
-PROCESS MODEL - The Narrative Must Show:
-PHASE 1 (Pre-Claim): Identify the Technological Uncertainty → Formulate SR&ED Hypothesis → Establish Documentation
-PHASE 2 (Preparation): Gather Evidence → Separate SR&ED work from routine work → Write narratives for Lines 242, 244, 246
-PHASE 3 (Filing/Review): Submit T661 form → Defend with Contemporaneous Documentation
-
-THE THREE NARRATIVE SECTIONS (T661 Form Lines 242, 244, 246):
-
-LINE 242 - TECHNOLOGICAL UNCERTAINTY:
-- What specific technical problem could NOT be resolved using standard practice or publicly known solutions?
-- Why was this problem non-obvious or novel? (Prove it wasn't routine)
-- What was the "whether" or "how" that wasn't known?
-- AVOID: Vague claims. BE SPECIFIC about what made this technically uncertain.
-
-LINE 244 - SYSTEMATIC INVESTIGATION (The Proof of Process):
-- What hypothesis did you formulate to test? (Specific, testable statement)
-- What experiments, tests, or analyses did you conduct?
-- What data did you collect? What tools, methods did you use?
-- Show a logical progression: Hypothesis → Test → Result → Conclusion
-- Include failed attempts - these are evidence of systematic investigation
-- AVOID: High-level summaries. BE CONCRETE about the investigation process.
-
-LINE 246 - TECHNOLOGICAL ADVANCEMENT (The Knowledge Gained):
-- What new knowledge or capability did you gain? (Not commercial success - knowledge itself)
-- How does this advance the underlying technology or field?
-- What was learned that changes how you or others would solve similar problems?
-- This can be negative learning too ("Approach X doesn't work" is advancement)
-- AVOID: Confusing product benefits with technological advancement.
-
-ENTITY MODEL - Key Relationships:
-Project is DEFINED BY Technological Uncertainty
-Project is TESTED VIA SR&ED Hypothesis
-Project is PROVEN BY Contemporaneous_Documentation (commits, tickets, lab notes, timesheets)
-Contemporaneous Documentation = Jira tickets, code commits, dated timesheets, meeting minutes, email threads, photos
-CRITICAL: Use existing tools (Jira, GitHub, Trello) with SR&ED tags as your evidence source
-
-COMMON PITFALLS TO AVOID:
-- Claiming "routine debugging" as SR&ED work
-- Vague language without specific technical details
-- Confusing business goals with technological uncertainty
-- Failing to show WHY existing solutions wouldn't work
-- Using future tense instead of describing actual completed work
-- Not separating SR&ED work from routine work
-"""
-    
-    system_prompt = """You are an expert Canadian SR&ED consultant. Your role is to analyze technical work and generate compelling, CRA-compliant narratives for the T661 form.
+@st.cache_resource
+def load_ocr_cache() -> OCRCache:
+    """Opens the on-disk OCR result cache once per process."""
+    return OCRCache()
 
-CRITICAL PRINCIPLES:
-1. SPECIFICITY: Always use concrete technical details (algorithm names, data structures, performance metrics, specific challenges)
-2. LINKING: Clearly connect technological uncertainty → systematic investigation → advancement (the three-part story)
-3. DISTINCTION: Actively separate SR&ED work from routine work; explain WHY the work was experimental/novel
-4. EVIDENCE: Reference documented activities (commits, tickets, tests, experiments) as proof of systematic investigation
-5. HONESTY: Failed experiments and negative results are valid SR&ED - show the investigation process, not just success
+@st.cache_resource
+def load_git_checkpoints() -> GitCheckpoints:
+    """Opens the per-repository "last processed commit" store once per process."""
+    return GitCheckpoints()
 
-TONE: Professional, technical, suitable for a CRA assessor with some software development / engineering / scientific knowledge, but not domain expert level in your specific technology.
+@st.cache_resource
+def load_history_store() -> HistoryStore:
+    """Opens the persistent SQLite narrative history once per process."""
+    return HistoryStore()
 
----
+@st.cache_resource
+def load_result_cache() -> ResultCache:
+    """Opens the SQLite narrative result cache once per process."""
+    return ResultCache()
 
-REFERENCE EXAMPLES (Few-Shot Training)
+@st.cache_resource
+def load_knowledge_index() -> KnowledgeIndex:
+    """Loads the research/ retrieval index from disk, rebuilding it if the files changed."""
+    return KnowledgeIndex()
 
-These examples demonstrate the pattern and structure for SR&ED-qualifying work narratives:
+@st.cache_resource
+def start_metrics_endpoint():
+    """Serves Prometheus-style metrics on SRED_METRICS_PORT once per process."""
+    return start_metrics_server(METRICS_PORT)
 
-EXAMPLE 1: Agri-Tech Automation
-Uncertainty: Could a novel humidity control mechanism stabilize rapidly changing greenhouse environments?
-Work: Developed and trialed several control algorithms, modified hardware configurations, logged results under variable conditions, reviewed failure modes systematically.
-Advancement: Clarified the instability factors affecting greenhouse automation, contributing new knowledge to agri-tech climate control through sensor response time analysis and algorithm tuning parameters.
+@st.cache_resource
+def load_job_queue() -> JobQueue:
+    """Starts the background generation workers and endpoint health checks once per process."""
+    job_queue = JobQueue(
+        EndpointPool(),
+        result_cache=load_result_cache(),
+        knowledge_index=load_knowledge_index(),
+        history_store=load_history_store(),
+        git_checkpoints=load_git_checkpoints(),
+    )
+    job_queue.start()
+    return job_queue
+
+def render_metrics_panel(metrics: dict) -> None:
+    """Collapsible breakdown of where a request's time went, with per-request token throughput."""
+    with st.expander("⏱️ Timings & inference metrics"):
+        st.caption(format_metrics(metrics))
+        st.table([{'Stage': stage, 'Seconds': f"{seconds:.2f}"} for stage, seconds in metrics['stages'].items()])
+        if metrics['requests']:
+            st.table([
+                {
+                    'Request': stats['stage'],
+                    'Prefill tokens': stats['prompt_eval_count'],
+                    'Prefill tok/s': f"{stats['prompt_tokens_per_second']:.0f}",
+                    'Output tokens': stats['eval_count'],
+                    'Decode tok/s': f"{stats['eval_tokens_per_second']:.1f}",
+                    'First token (s)': f"{stats['first_token_seconds']:.2f}" if 'first_token_seconds' in stats else "–",
+                    'Wall (s)': f"{stats['wall_seconds']:.2f}",
+                }
+                for stats in metrics['requests']
+            ])
+
+def select_history_entry(entry_id: int | None) -> None:
+    """Button callback: opens (or with None, closes) one history entry in the sidebar."""
+    st.session_state.history_selected = entry_id
+
+def change_history_page(delta: int) -> None:
+    """Button callback: moves the sidebar history listing by delta pages."""
+    st.session_state.history_page += delta
+    st.session_state.history_selected = None
+
+def render_history_entry(entry: dict) -> None:
+    """Shows one opened history entry, loading its narrative from the store only now."""
+    narrative = history_store.narrative(entry['id'])
+    with st.expander(f"📄 Result {entry['id']} - {entry['timestamp']}", expanded=True):
+        if narrative is None:
+            st.warning("This entry is no longer available.")
+            return
+        st.text_area("View narrative", value=narrative, height=200, disabled=True)
+        if entry['metrics']:
+            st.caption(f"⏱️ {format_metrics(entry['metrics'])}")
+        st.download_button(
+            label=f"Download Result {entry['id']}",
+            data=narrative,
+            file_name=f"sred_narrative_{entry['id']}_{entry['timestamp'].replace(':', '-')}.txt",
+            key=f"download_{entry['id']}"
+        )
+        st.button("Close", key=f"history_close_{entry['id']}", on_click=select_history_entry, args=(None,))
 
-EXAMPLE 2: Food Processing R&D
-Uncertainty: Would natural preservative alternatives maintain shelf life and safety under real-world pH variation?
-Work: Formulated experimental batches, varied pH conditions to simulate storage scenarios, tracked spoilage indicators, performed stability tests.
-Advancement: Negative results revealed critical failure factors—specifically, pH sensitivity was higher than expected. These conclusions informed future development and advanced understanding of natural preservative chemistry.
+def dismiss_job() -> None:
+    """Button callback: hides the background job panel."""
+    st.query_params.pop("job", None)
 
-EXAMPLE 3: Manufacturing Alloy Development
-Uncertainty: Could new alloy compositions increase tool durability beyond commercial standards under elevated temperatures?
-Work: Designed multiple prototype compositions with varying nickel percentages, manufactured test samples, tested at progressively escalating temperatures to identify failure points.
-Advancement: Discovered a technical limit to temperature resistance and documented the precise role of nickel percentage. This clarified the composition-durability relationship, advancing sector knowledge.
+def render_job_notes(job: dict) -> None:
+    for note in job['notes']:
+        notify_streamlit(note['level'], note['message'])
 
-EXAMPLE 4: Software Algorithm Optimization
-Uncertainty: Could novel algorithms optimize large dataset sorting without common performance bottlenecks?
-Work: Formulated efficiency hypothesis, coded and compared multiple algorithm variants, used 8M+ record benchmarking dataset, logged both successes and edge-case failures.
-Advancement: Identified the true bottleneck (memory access patterns vs. computational complexity) and published a new algorithm approach addressing this limitation."""
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_active_job(job_id: str) -> None:
+    """
+    Polls a queued or running job and redraws its progress and streamed output.
+    Only this fragment reruns while polling; once the job finishes the whole page
+    reruns so the result and the history sidebar are drawn once.
+    """
+    job = job_queue.get(job_id)
+    if job is None or job['status'] not in ACTIVE_STATUSES:
+        st.rerun()
+    if job['status'] == "queued":
+        position = job_queue.store.queue_position(job_id)
+        st.info(f"⏳ Queued (position {position}); waiting for a free Ollama endpoint. You can refresh or leave this page.")
+    else:
+        attempt = f", attempt {job['attempts']}" if job['attempts'] > 1 else ""
+        st.caption(f"🖥️ Running on {job['endpoint']}{attempt}. You can refresh or leave this page; the job keeps running.")
+    render_job_notes(job)
+    if job['progress'] and job['progress']['total']:
+        progress = job['progress']
+        st.progress(progress['done'] / progress['total'], text=f"{progress['stage']} {progress['done']}/{progress['total']}")
     
-    user_prompt = f"""{knowledge_base_context}
-
----EXTRACTED TECHNICAL DATA TO ANALYZE---
-{extracted_text}
-
----YOUR TASK---
-Analyze the above technical data and generate a compelling technical narrative for a Canadian SR&ED claim.
-
-Structure your response with THREE clearly labeled sections (one for each form field):
-
-## Line 242: Technological Uncertainty
-Describe the specific technical problem or challenge that could NOT be resolved using standard practice or publicly known solutions. Explain WHY this was uncertain/non-obvious. Be specific about what made this work experimental.
-
-## Line 244: Systematic Investigation
-Detail the methodical approach used to test the hypothesis. Describe:
-- The specific hypothesis you were testing
-- Experiments or tests conducted
-- Data collected and analyzed
-- Tools and methods used
-- Logical progression from hypothesis → test → result
-- Include any failed attempts or negative results (these prove systematic investigation)
-
-## Line 246: Technological Advancement
-Explain the new knowledge or capability gained. Describe:
-- What did you learn that advances the underlying technology/field?
-- How does this change how the problem would be solved in the future?
-- What new understanding was gained (even if negative/failure results)?
-- Why is this advancement in TECHNOLOGY, not just in the product?
-
-QUALITY GUIDELINES:
-- Use specific technical terms, algorithm names, metrics (not generic language)
-- Show WHY existing solutions/APIs/frameworks wouldn't work
-- Explicitly separate SR&ED work from routine work
-- Use active voice describing completed work (not future tense)
-- Reference specific dates, tools, people when helpful
-- Keep narrative cohesive: the three sections should tell ONE continuous story"""
+    # Kept across polls so each poll only parses the output that arrived since the last one
+    stream = st.session_state.get('job_stream')
+    if (stream is None or stream['job'] != job_id or stream['attempt'] != job['attempts']
+            or len(job['partial']) < stream['fed']):
+        stream = st.session_state.job_stream = {'job': job_id, 'attempt': job['attempts'], 'parser': NarrativeStreamParser(), 'fed': 0}
+    parser = stream['parser']
+    parser.feed(job['partial'][stream['fed']:])
+    stream['fed'] = len(job['partial'])
+    thinking_placeholder = st.expander("🤔 View AI's Thinking Process").empty()
+    st.markdown("---")
+    st.subheader("📋 Technical Narrative for T661 Form")
+    render_stream_progress(parser, thinking_placeholder, st.empty(), st.empty())
+
+def render_job(job_id: str) -> None:
+    """Shows a background job: live while it runs, then its narrative, metrics and download."""
+    st.header("2. AI-Generated SR&ED Narrative")
+    job = job_queue.get(job_id)
+    if job is None:
+        st.warning("This job no longer exists.")
+        st.button("Dismiss", on_click=dismiss_job)
+        return
+    if job['status'] in ACTIVE_STATUSES:
+        render_active_job(job_id)
+        return
     
-    try:
-        response = ollama.chat(
-            model='sred-expert',
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': user_prompt}
-            ],
-            options={'temperature': 0.5}
+    render_job_notes(job)
+    if job['status'] == "done":
+        thinking_process, formatted_narrative, full_output_for_download = format_narrative_output(job['result'])
+        with st.expander("🤔 View AI's Thinking Process"):
+            st.markdown(thinking_process)
+        st.markdown("---")
+        st.subheader("📋 Technical Narrative for T661 Form")
+        st.markdown(formatted_narrative)
+    else:
+        st.error(job['error'] or "Failed to generate narrative. Check Ollama connection.")
+    if job['metrics']:
+        for stats in job['metrics']['requests']:
+            st.caption(f"🧮 {format_prompt_stats(stats)}")
+        render_metrics_panel(job['metrics'])
+    if job['status'] == "done":
+        st.download_button(
+            label="💾 Download Narrative",
+            data=full_output_for_download,
+            file_name=f"sred_narrative_{datetime.fromtimestamp(job['updated_at']).strftime('%Y%m%d_%H%M%S')}.txt",
+            mime="text/plain"
         )
-        return response['message']['content']
-    except Exception as e:
-        st.error(f"Error communicating with Ollama. Is the 'sred-expert' model running? Details: {e}")
-        return ""
+        if job['history_id'] is not None:
+            st.success(f"✅ Narrative added to history as Result {job['history_id']}!")
+        if job['request']['git_checkpoint']:
+            st.caption(f"📌 Checkpoint saved at commit {job['request']['git_checkpoint'][2][:10]}; \"Only commits since the last run\" will start after it.")
+    st.button("Dismiss", on_click=dismiss_job)
+
+def load_ocr_reader():
+    """Reader factory for run_ocr_jobs, only called on an OCR cache miss; shows a spinner while EasyOCR loads."""
+    if reader_loaded():
+        return get_reader()
+    with st.spinner("📖 Loading EasyOCR..."):
+        return get_reader()
+
+def notify_streamlit(level: str, message: str) -> None:
+    """Shows NarrativeGenerator messages in the current Streamlit container."""
+    {'info': st.info, 'caption': st.caption, 'warning': st.warning, 'error': st.error}.get(level, st.write)(message)
 
-def format_narrative_output(raw_output: str) -> tuple[str, str, str]:
+def make_progress_callback():
     """
-    Splits the raw narrative into thinking process and formatted output.
-    Returns: (thinking_process, formatted_narrative, full_output_for_download)
+    Returns an on_progress(stage, done, total) callback that draws one Streamlit
+    progress bar per stage run, starting a new bar whenever a stage restarts at 0.
     """
-    # Split by the first occurrence of "## Line 242" to separate thinking from output
-    lines = raw_output.split("\n")
-    thinking_lines = []
-    narrative_lines = []
-    in_narrative = False
-    
-    for line in lines:
-        if "## Line 242" in line:
-            in_narrative = True
-        
-        if in_narrative:
-            narrative_lines.append(line)
-        else:
-            thinking_lines.append(line)
-    
-    thinking_text = "\n".join(thinking_lines).strip()
-    narrative_text = "\n".join(narrative_lines).strip()
+    labels = {'evidence': "Extracted evidence from {done}/{total} chunks", 'narratives': "Generated {done}/{total} narratives"}
+    bars = {}
     
-    # Enhance formatting: add bullets and structure
-    formatted_narrative = enhance_narrative_formatting(narrative_text)
+    def on_progress(stage: str, done: int, total: int) -> None:
+        text = labels.get(stage, stage + " {done}/{total}").format(done=done, total=total)
+        if done == 0 or stage not in bars:
+            bars[stage] = st.progress(0.0, text=text)
+        bars[stage].progress(done / total if total else 1.0, text=text)
     
-    # Full output includes both thinking and narrative for download
-    full_output = f"=== AI THINKING PROCESS ===\n\n{thinking_text}\n\n=== TECHNICAL NARRATIVE FOR T661 FORM ===\n\n{formatted_narrative}"
-    
-    return thinking_text, formatted_narrative, full_output
+    return on_progress
+
+def render_stream_progress(parser: NarrativeStreamParser, thinking_placeholder, status_placeholder, narrative_placeholder) -> None:
+    """Redraws the live thinking/narrative placeholders from the parser's current state."""
+    thinking, narrative = parser.snapshot()
+    thinking_placeholder.markdown(thinking or "_Waiting for the model..._")
+    if parser.current_section is None:
+        status_placeholder.caption("🤔 The AI is reasoning about your data...")
+    else:
+        status_placeholder.caption(f"✍️ Drafting {parser.current_section.lstrip('# ')}...")
+    narrative_placeholder.markdown(narrative)
 
-def enhance_narrative_formatting(narrative: str) -> str:
+def make_stream_callback(parser: NarrativeStreamParser, thinking_placeholder, status_placeholder, narrative_placeholder):
     """
-    Enhances narrative formatting with bullets, bold text, and clearer section separation.
+    Returns an on_chunk callback that feeds the parser and redraws the placeholders,
+    throttled to STREAM_RENDER_INTERVAL since re-rendering markdown per token is wasteful.
     """
-    formatted = narrative.replace("**", "**")  # Preserve bold
-    # Add more visual separation
-    formatted = formatted.replace("## Line 242", "\n---\n## 📋 Line 242: Technological Uncertainty\n---")
-    formatted = formatted.replace("## Line 244", "\n---\n## 📋 Line 244: Systematic Investigation\n---")
-    formatted = formatted.replace("## Line 246", "\n---\n## 📋 Line 246: Technological Advancement\n---")
+    last_render = 0.0
     
-    return formatted
-
-def process_multiple_inputs(source_texts: list[str], mode: str) -> str:
-    """
-    Process multiple input texts based on user preference.
-    mode: "combined" or "separate"
-    """
-    if mode == "combined":
-        # Merge all texts into one context
-        combined_text = "\n\n---\n\n".join(source_texts)
-        return generate_narrative_local(combined_text)
-    else:
-        # Generate separate narratives and combine them
-        narratives = []
-        for i, text in enumerate(source_texts, 1):
-            st.write(f"Processing input {i}/{ len(source_texts)}...")
-            narrative = generate_narrative_local(text)
-            narratives.append(f"### Narrative {i}\n\n{narrative}")
-        return "\n\n---\n\n".join(narratives)
+    def on_chunk(chunk: str) -> None:
+        nonlocal last_render
+        parser.feed(chunk)
+        if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+            render_stream_progress(parser, thinking_placeholder, status_placeholder, narrative_placeholder)
+            last_render = time.monotonic()
+    
+    return on_chunk
 
 # --- SESSION STATE INITIALIZATION ---
-if 'history' not in st.session_state:
-    st.session_state.history = []
+# History itself lives in SQLite; the session only tracks which page and entry are open
+if 'history_page' not in st.session_state:
+    st.session_state.history_page = 0
+if 'history_selected' not in st.session_state:
+    st.session_state.history_selected = None
 
 # --- UI & APPLICATION LOGIC ---
 
@@ -243,25 +275,87 @@ st.set_page_config(layout="wide", page_title="SR&ED GPT", page_icon="🍁")
 st.title("🍁 SR&ED GPT")
 st.subheader("Your AI Co-pilot for Canadian R&D Tax Credits")
 
-# Load the OCR reader at the start
-reader = load_ocr_reader()
+# Open the OCR/narrative caches and the knowledge base index; the OCR reader loads on demand
+ocr_cache = load_ocr_cache()
+result_cache = load_result_cache()
+knowledge_index = load_knowledge_index()
+history_store = load_history_store()
+job_queue = load_job_queue()
+if METRICS_PORT:
+    start_metrics_endpoint()
 
-# --- SIDEBAR: SESSION HISTORY ---
+# --- SIDEBAR: HISTORY ---
 with st.sidebar:
-    st.header("📚 Session History")
-    if st.session_state.history:
-        st.write(f"**Generated Narratives:** {len(st.session_state.history)}")
-        for i, item in enumerate(st.session_state.history, 1):
-            with st.expander(f"📄 Result {i} - {item['timestamp']}"):
-                st.text_area("View narrative", value=item['output'], height=200, disabled=True)
-                st.download_button(
-                    label=f"Download Result {i}",
-                    data=item['output'],
-                    file_name=f"sred_narrative_{i}_{item['timestamp'].replace(':', '-')}.txt",
-                    key=f"download_{i}"
+    st.header("📚 History")
+    history_total = history_store.count()
+    if history_total:
+        page_count = (history_total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        st.session_state.history_page = min(max(0, st.session_state.history_page), page_count - 1)
+        st.write(f"**Generated Narratives:** {history_total}")
+        # Only metadata is read for the listing; a narrative is loaded when its entry is opened
+        for entry in history_store.page(st.session_state.history_page, HISTORY_PAGE_SIZE):
+            if entry['id'] == st.session_state.history_selected:
+                render_history_entry(entry)
+            else:
+                st.button(
+                    f"📄 Result {entry['id']} - {entry['timestamp']}",
+                    key=f"history_open_{entry['id']}",
+                    on_click=select_history_entry,
+                    args=(entry['id'],),
+                    help=entry['title'],
+                    use_container_width=True
                 )
+        if page_count > 1:
+            prev_col, page_col, next_col = st.columns([1, 2, 1])
+            prev_col.button("◀", key="history_prev", on_click=change_history_page, args=(-1,), disabled=st.session_state.history_page == 0)
+            page_col.caption(f"Page {st.session_state.history_page + 1} of {page_count}")
+            next_col.button("▶", key="history_next", on_click=change_history_page, args=(1,), disabled=st.session_state.history_page >= page_count - 1)
     else:
-        st.info("💡 Generated narratives will appear here during your session.")
+        st.info("💡 Generated narratives will appear here and are kept between sessions.")
+    
+    with st.expander("⚙️ Performance Settings"):
+        ocr_workers = st.number_input(
+            "OCR parallelism (images at once)",
+            min_value=1,
+            max_value=max(1, os.cpu_count() or 1),
+            value=min(OCR_WORKERS, max(1, os.cpu_count() or 1)),
+            help="How many uploaded images are OCRed concurrently. Higher values use more cores and memory."
+        )
+        generation_concurrency = st.number_input(
+            "Parallel generations",
+            min_value=1,
+            max_value=16,
+            value=max(1, OLLAMA_CONCURRENCY),
+            help="How many requests are sent to Ollama at once for separate-mode narratives and for evidence extraction from long inputs. Match this to OLLAMA_NUM_PARALLEL on the server; 1 streams separate narratives one by one."
+        )
+        cache_stats = result_cache.stats()
+        st.caption(
+            f"♻️ Result cache: {cache_stats['hits']} hits / {cache_stats['hits'] + cache_stats['misses']} lookups "
+            f"({cache_stats['hit_rate']:.0%} hit rate), {cache_stats['bypasses']} bypassed, {cache_stats['entries']} stored"
+        )
+        if RETRIEVAL_TOP_K > 0:
+            st.caption(f"📚 Knowledge base: top {RETRIEVAL_TOP_K} of {knowledge_index.passage_count} indexed passages per request")
+        else:
+            st.caption("📚 Knowledge base: retrieval off, full fixed context in every prompt")
+        
+        run_in_background = st.checkbox(
+            "Run generations in the background queue",
+            value=BACKGROUND_JOBS_DEFAULT,
+            help="Queue narratives on background workers spread over the Ollama endpoints in SRED_OLLAMA_HOSTS. Progress survives reruns and page refreshes."
+        )
+        for endpoint in job_queue.pool.status():
+            health = "🟢" if endpoint['healthy'] else f"🔴 down ({endpoint['last_error']})"
+            st.caption(f"🖥️ {endpoint['host']}: {health}, {endpoint['in_flight']}/{endpoint['max_concurrency']} requests")
+        
+        if st.checkbox(
+            "Warm up OCR and model in background",
+            value=WARMUP_DEFAULT,
+            help="Preload EasyOCR and load the model into Ollama while you prepare your input, so the first request starts faster."
+        ):
+            st.caption(f"🔥 Warm-up: {start_background_warm_up().summary()}")
+        
+        # Filled in at the end of the script, once the first render has been timed
+        cold_start_caption = st.empty()
 
 # --- MAIN CONTENT ---
 col1, col2 = st.columns(2)
@@ -270,7 +364,7 @@ with col1:
     st.header("1. Provide Your Technical Data")
     
     # Using tabs for different input methods
-    input_tab1, input_tab2 = st.tabs(["📄 Paste Text", "📸 Upload Image(s)"])
+    input_tab1, input_tab2, input_tab3 = st.tabs(["📄 Paste Text", "📸 Upload Image(s)", "🌿 Git Repository"])
 
     with input_tab1:
         user_input_text = st.text_area(
@@ -299,9 +393,48 @@ with col1:
             )
         else:
             process_mode = "combined"
+    
+    with input_tab3:
+        st.write("**Read commits directly from a local repository (no screenshots or OCR needed):**")
+        git_repo_path = st.text_input("Repository path", placeholder="/path/to/your/repo")
+        git_branch = st.text_input("Branch or revision", value="HEAD")
+        git_col1, git_col2 = st.columns(2)
+        with git_col1:
+            git_since = st.date_input("From date", value=None)
+        with git_col2:
+            git_until = st.date_input("To date", value=None)
+        git_incremental = st.checkbox(
+            "Only commits since the last run",
+            value=False,
+            help="Skip commits already used in a successful narrative for this repository and branch"
+        )
+        git_tags = st.text_input(
+            "SR&ED tags (comma-separated)",
+            value=", ".join(GIT_TAGS),
+            help="Keep commits whose message mentions any of these. Leave both filters empty to keep every commit."
+        )
+        git_ticket_prefixes = st.text_input(
+            "Ticket prefixes (comma-separated)",
+            value=", ".join(GIT_TICKET_PREFIXES),
+            placeholder="e.g. RD-, PROJ-",
+            help="Keep commits referencing a ticket such as RD-123"
+        )
+
+    stream_output = st.checkbox(
+        "Stream output as it is generated",
+        value=True,
+        help="Show the AI's thinking and narrative sections live instead of waiting for the full response"
+    )
+
+    regenerate_anyway = st.checkbox(
+        "♻️ Regenerate anyway",
+        value=False,
+        help="Ignore cached narratives for identical inputs and ask the model again"
+    )
 
     if st.button("🚀 Generate SR&ED Narrative", type="primary", use_container_width=True):
         source_texts = []
+        request_metrics = RequestMetrics()
         
         # Collect text input
         if user_input_text:
@@ -309,40 +442,129 @@ with col1:
         
         # Collect image inputs
         if uploaded_files:
-            with st.spinner("📖 Reading images with EasyOCR..."):
-                for uploaded_file in uploaded_files:
-                    try:
-                        # Load image with PIL and convert to RGB first
-                        image = Image.open(uploaded_file).convert('RGB')
-                        # Convert PIL Image to numpy array (RGB format)
-                        image_rgb = np.array(image, dtype=np.uint8)
-                        # Convert RGB to BGR for OpenCV/EasyOCR compatibility
-                        image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
-                        # Ensure the array is contiguous in memory
-                        image_bgr = np.ascontiguousarray(image_bgr)
-                        # Pass BGR image to EasyOCR
-                        results = reader.readtext(image_bgr)
-                        extracted = "\n".join([result[1] for result in results])
-                        source_texts.append(extracted)
-                        
-                        # Show extracted text in an expander
-                        with st.expander(f"📝 Extracted Text from {uploaded_file.name}"):
-                            st.text(extracted)
-                    except Exception as e:
-                        st.error(f"❌ Error processing {uploaded_file.name}: {str(e)}")
+            with st.spinner("📖 Reading images..."):
+                ocr_progress = st.progress(0.0, text=f"OCR 0/{len(uploaded_files)} images")
+                
+                def on_ocr_progress(done: int, total: int, result) -> None:
+                    status = "cache hit" if result.cache_hit else ("failed" if result.error else f"{result.seconds:.1f}s")
+                    ocr_progress.progress(done / total, text=f"OCR {done}/{total} images (last: {result.name}, {status})")
+                
+                ocr_started = time.perf_counter()
+                jobs = [OCRJob(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+                ocr_results = run_ocr_jobs(jobs, load_ocr_reader, ocr_settings(), cache=ocr_cache, workers=ocr_workers, on_progress=on_ocr_progress)
+                request_metrics.record_stage("ocr", time.perf_counter() - ocr_started)
+                request_metrics.count("ocr_images", len(ocr_results))
+                request_metrics.count("ocr_cache_hits", sum(result.cache_hit for result in ocr_results))
+                
+                for result in ocr_results:
+                    if result.error is not None:
+                        st.error(f"❌ Error processing {result.name}: {result.error}")
                         continue
+                    source_texts.append(result.text)
+                    
+                    # Show extracted text in an expander
+                    with st.expander(f"📝 Extracted Text from {result.name}"):
+                        if result.cache_hit:
+                            st.caption("⚡ OCR cache hit: reused text from a previous run")
+                        else:
+                            st.caption(f"🔍 OCR cache miss: text extracted in {result.seconds:.1f}s and saved to cache")
+                        st.text(result.text)
+        
+        # Collect commits from a local git repository
+        git_result = None
+        if git_repo_path.strip():
+            git_started = time.perf_counter()
+            try:
+                git_result = read_repository(
+                    Path(git_repo_path.strip()),
+                    branch=git_branch.strip() or "HEAD",
+                    since=f"{git_since.isoformat()} 00:00:00" if git_since else None,
+                    until=f"{git_until.isoformat()} 23:59:59" if git_until else None,
+                    incremental=git_incremental,
+                    tags=split_list(git_tags),
+                    ticket_prefixes=split_list(git_ticket_prefixes),
+                    checkpoints=load_git_checkpoints(),
+                )
+            except GitIngestError as e:
+                st.error(f"❌ Could not read the repository: {e}")
+            request_metrics.record_stage("git", time.perf_counter() - git_started)
+            if git_result is not None:
+                skipped = ", ".join(f"{count} {reason}" for reason, count in git_result.skipped.items())
+                if git_result.commits:
+                    source_texts.append(git_result.text)
+                    request_metrics.count("git_commits", len(git_result.commits))
+                    with st.expander(f"🌿 {len(git_result.commits)} commits from {git_result.revision_range}"):
+                        if skipped:
+                            st.caption(f"Skipped: {skipped}")
+                        if git_result.truncated:
+                            st.caption(f"Limited to the oldest {len(git_result.commits)} matching commits, up to {git_result.head[:10]}; an incremental run continues after it.")
+                        st.text(git_result.text)
+                else:
+                    st.warning(f"⚠️ No matching commits in {git_result.revision_range}" + (f" (skipped: {skipped})" if skipped else "."))
         
+        # A single input goes through the combined path, which also handles oversized text
+        mode = process_mode if len(source_texts) > 1 else "combined"
         if not source_texts:
-            st.warning("⚠️ Please paste text or upload image(s) first.")
+            st.warning("⚠️ Please paste text, upload image(s) or choose a git repository first.")
+        elif run_in_background:
+            # The worker saves history and the git checkpoint itself, so the job completes even if this page is closed
+            job_id = job_queue.submit(JobRequest(
+                source_texts,
+                mode,
+                concurrency=generation_concurrency,
+                use_cache=not regenerate_anyway,
+                stages=dict(request_metrics.stages),
+                git_checkpoint=(git_repo_path.strip(), git_branch.strip() or "HEAD", git_result.head) if git_result is not None and git_result.commits else None,
+            ))
+            # Kept in the URL so a refresh reopens the same job
+            st.query_params["job"] = job_id
         else:
             with col2:
                 st.header("2. AI-Generated SR&ED Narrative")
-                with st.spinner("🤖 Consulting the AI expert... (this may take 30-60 seconds per input)"):
-                    # Process inputs based on mode
-                    if len(source_texts) > 1:
-                        narrative_output = process_multiple_inputs(source_texts, process_mode)
-                    else:
-                        narrative_output = generate_narrative_local(source_texts[0])
+                
+                def run_generation(on_chunk=None) -> str:
+                    # In-page generations take slots from the same endpoint pool as background jobs
+                    with st.spinner("⏳ Waiting for a free Ollama endpoint..."):
+                        lease = job_queue.pool.acquire(parallel_requests(source_texts, mode, generation_concurrency))
+                    if lease is None:
+                        st.error("No healthy Ollama endpoint is available. Check Ollama connection.")
+                        return ""
+                    endpoint, slots = lease
+                    generator = NarrativeGenerator(result_cache, knowledge_index, host=endpoint.url,
+                                                   notify=notify_streamlit, on_progress=make_progress_callback())
+                    try:
+                        return generator.process_multiple_inputs(
+                            source_texts, mode, on_chunk=on_chunk, concurrency=slots,
+                            on_stats=request_metrics.add_inference, use_cache=not regenerate_anyway,
+                            on_timing=request_metrics.record_stage
+                        )
+                    except NarrativeGenerationError as e:
+                        # Lets the pool stop sending work to the endpoint if it is down
+                        job_queue.pool.check(endpoint)
+                        st.error(str(e))
+                        return ""
+                    finally:
+                        job_queue.pool.release(endpoint, slots)
+                
+                if stream_output:
+                    # Render tokens as they arrive, splitting thinking and sections on the fly
+                    parser = NarrativeStreamParser()
+                    thinking_placeholder = st.expander("🤔 View AI's Thinking Process").empty()
+                    st.markdown("---")
+                    st.subheader("📋 Technical Narrative for T661 Form")
+                    status_placeholder = st.empty()
+                    narrative_placeholder = st.empty()
+                    on_chunk = make_stream_callback(parser, thinking_placeholder, status_placeholder, narrative_placeholder)
+                    
+                    narrative_output = run_generation(on_chunk)
+                    
+                    thinking_process, formatted_narrative, full_output_for_download = parser.finish()
+                    status_placeholder.empty()
+                    thinking_placeholder.markdown(thinking_process)
+                    narrative_placeholder.markdown(formatted_narrative)
+                else:
+                    with st.spinner("🤖 Consulting the AI expert... (this may take 30-60 seconds per input)"):
+                        narrative_output = run_generation()
                     
                     if narrative_output:
                         # Split into thinking and narrative
@@ -356,27 +578,41 @@ with col1:
                         st.markdown("---")
                         st.subheader("📋 Technical Narrative for T661 Form")
                         st.markdown(formatted_narrative)
-                        
-                        # Download button with full output (thinking + narrative)
-                        st.download_button(
-                            label="💾 Download Narrative",
-                            data=full_output_for_download,
-                            file_name=f"sred_narrative_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                            mime="text/plain"
-                        )
-                        
-                        # Add to session history
-                        st.session_state.history.append({
-                            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            'output': formatted_narrative,
-                            'input_count': len(source_texts)
-                        })
-                        st.success("✅ Narrative added to session history!")
-                    else:
-                        st.error("Failed to generate narrative. Check Ollama connection.")
+                
+                # Prefill token counts show how much of the static prompt prefix Ollama reused
+                for stats in request_metrics.inferences:
+                    st.caption(f"🧮 {format_prompt_stats(stats)}")
+                metrics = request_metrics.finish()
+                record_request(metrics, "app", mode=mode, inputs=len(source_texts), succeeded=bool(narrative_output))
+                render_metrics_panel(metrics)
+                
+                if narrative_output:
+                    # Download button with full output (thinking + narrative)
+                    st.download_button(
+                        label="💾 Download Narrative",
+                        data=full_output_for_download,
+                        file_name=f"sred_narrative_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+                        mime="text/plain"
+                    )
+                    
+                    # Save to the persistent history
+                    history_store.add(formatted_narrative, len(source_texts), metrics)
+                    st.success("✅ Narrative added to history!")
+                    
+                    # Only advance the checkpoint once the commits have produced a narrative
+                    if git_result is not None and git_result.commits:
+                        load_git_checkpoints().set(Path(git_repo_path.strip()), git_branch.strip() or "HEAD", git_result.head)
+                        st.caption(f"📌 Checkpoint saved at commit {git_result.head[:10]}; \"Only commits since the last run\" will start after it.")
+                else:
+                    st.error("Failed to generate narrative. Check Ollama connection.")
+
+active_job_id = st.query_params.get("job")
+if active_job_id and 'narrative_output' not in locals():
+    with col2:
+        render_job(active_job_id)
 
 with col2:
-    if 'narrative_output' not in locals():
+    if 'narrative_output' not in locals() and not active_job_id:
         st.header("2. AI-Generated Narrative")
         st.info("""
             **How to Use:**
@@ -395,7 +631,7 @@ with col2:
             **Features:**
             - 🤔 View AI's thinking process (hidden by default for cleaner UI)
             - 📝 Formatted narrative with clear sections
-            - 📚 Session history sidebar for quick access to past generations
+            - 📚 History sidebar for quick access to past generations, kept between sessions
             - 💾 Download narratives for offline editing
             
             **Disclaimer:** This is an AI-powered tool for generating drafts. Always review and edit the output with a qualified SR&ED consultant before submission to the CRA.
@@ -416,3 +652,9 @@ with col2:
             - ❌ Business or market uncertainty alone
             - ❌ Product improvements without underlying tech advancement
         """)
+
+startup_timer.mark("first render")
+cold_start_caption.caption(
+    f"⏱️ Cold start: app imports done {startup_timer.get('app imports'):.2f}s and "
+    f"first render {startup_timer.get('first render'):.2f}s after process start"
+)
@@ -0,0 +1,322 @@
+"""
+Headless batch narrative generation.
+
+Usage:
+    python batch.py demo_assets/inputs --output-dir batch_outputs
+    python batch.py --git-repo ~/src/project --incremental --output-dir batch_outputs
+
+Every supported file directly inside the input directory is one item, and every
+subdirectory is one item whose files are combined into a single narrative (one
+project folder per claim). Items flow through a bounded pipeline: a reader
+thread loads text and OCRs images (through the shared OCR cache) into a queue
+of limited size, and generation workers drain it. For each item the narrative
+is written to "<name> sred_narrative.txt" and a record is appended to
+results.jsonl. Items already recorded as "ok" with the same content hash are
+skipped, so an interrupted run can simply be restarted. A run summary with
+throughput and per-item latency is printed and written to run_summary.json.
+
+With --git-repo, the repository's filtered commits become one more item (see
+git_ingest.py); its checkpoint advances only when that narrative succeeds.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import queue
+import statistics
+import sys
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from git_ingest import GIT_TAGS, GIT_TICKET_PREFIXES, GitCheckpoints, GitIngestError, read_repository, split_list
+from metrics import METRICS_PORT, RequestMetrics, record_request, start_metrics_server
+from narrative import OLLAMA_CONCURRENCY, NarrativeGenerator, format_narrative_output
+from ocr_cache import OCRCache
+from ocr_engine import OCRJob, get_reader, ocr_settings, run_ocr_jobs
+from result_cache import ResultCache
+from retrieval import KnowledgeIndex
+
+logger = logging.getLogger("sred.batch")
+
+TEXT_SUFFIXES = {'.txt', '.md', '.log'}
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg'}
+MANIFEST_NAME = "results.jsonl"
+SUMMARY_NAME = "run_summary.json"
+
+
+@dataclass
+class BatchItem:
+    name: str
+    files: list[Path]
+    item_id: str = ""
+    texts: list[str] = field(default_factory=list)
+    ocr_seconds: float = 0.0
+    error: str | None = None
+    # Called after the item's narrative is written, e.g. to advance a git checkpoint
+    on_success: Callable[[], None] | None = None
+
+
+def is_supported(path: Path) -> bool:
+    return path.is_file() and path.suffix.lower() in TEXT_SUFFIXES | IMAGE_SUFFIXES
+
+
+def content_id(name: str, files: list[Path]) -> str:
+    """Identifies an item by its name and the bytes of its files, so edited inputs are redone."""
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(path.name.encode("utf-8"))
+        digest.update(path.read_bytes())
+    return f"{name}:{digest.hexdigest()[:16]}"
+
+
+def discover_items(input_dir: Path) -> list[BatchItem]:
+    """Top-level files are single items; each subdirectory is one combined item."""
+    items = []
+    for entry in sorted(input_dir.iterdir()):
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            files = sorted(path for path in entry.rglob('*') if is_supported(path))
+        elif is_supported(entry):
+            files = [entry]
+        else:
+            continue
+        if files:
+            name = entry.name if entry.is_dir() else entry.stem
+            items.append(BatchItem(name=name, files=files, item_id=content_id(name, files)))
+    return items
+
+
+def load_completed(manifest_path: Path) -> set[str]:
+    """Item ids already recorded as successfully completed."""
+    completed = set()
+    if not manifest_path.exists():
+        return completed
+    for line in manifest_path.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A crash mid-write can leave a partial last line
+            continue
+        if record.get('status') == 'ok':
+            completed.add(record['id'])
+    return completed
+
+
+class OCRStage:
+    """Loads item files as text, OCRing images through the shared OCR cache. The reader loads on first use."""
+
+    def __init__(self, cache: OCRCache, workers: int):
+        self.cache = cache
+        self.workers = workers
+
+    def load(self, item: BatchItem) -> None:
+        started = time.perf_counter()
+        jobs = []
+        for path in item.files:
+            if path.suffix.lower() in TEXT_SUFFIXES:
+                item.texts.append(path.read_text(encoding="utf-8", errors="replace"))
+            else:
+                jobs.append(OCRJob(path.name, path.read_bytes()))
+        if jobs:
+            for result in run_ocr_jobs(jobs, get_reader, ocr_settings(), cache=self.cache, workers=self.workers):
+                if result.error is not None:
+                    logger.warning("OCR failed for %s: %s", result.name, result.error)
+                elif result.text.strip():
+                    item.texts.append(result.text)
+        item.ocr_seconds = time.perf_counter() - started
+        if not item.texts:
+            item.error = "no text could be read from the item's files"
+
+
+def git_item(repo: Path, branch: str, since: str | None, until: str | None, incremental: bool,
+             tags: list[str], ticket_prefixes: list[str]) -> BatchItem | None:
+    """One item holding the repository's selected commits, or None if none match."""
+    checkpoints = GitCheckpoints()
+    result = read_repository(repo, branch=branch, since=since, until=until, incremental=incremental,
+                             tags=tags, ticket_prefixes=ticket_prefixes, checkpoints=checkpoints)
+    logger.info("%s: %d commits selected from %s (skipped: %s)", repo, len(result.commits), result.revision_range, result.skipped or "none")
+    if result.truncated:
+        logger.info("%s: commit limit reached at %s; the next incremental run continues after it", repo, result.head[:10])
+    if not result.commits:
+        return None
+    name = f"{repo.resolve().name} git {result.head[:10]}"
+    return BatchItem(
+        name=name,
+        files=[],
+        item_id=f"git:{repo.resolve()}:{result.revision_range}:{result.head}:{since}:{until}",
+        texts=[result.text],
+        on_success=lambda: checkpoints.set(repo, branch, result.head),
+    )
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_batch(input_dir: Path | None, output_dir: Path, concurrency: int, queue_size: int, ocr_workers: int,
+              use_cache: bool = True, host: str | None = None, extra_items: list[BatchItem] | None = None) -> dict:
+    """Processes every pending item in input_dir plus extra_items and returns the run summary."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_NAME
+    items = (discover_items(input_dir) if input_dir is not None else []) + (extra_items or [])
+    completed = load_completed(manifest_path)
+    pending = [item for item in items if item.item_id not in completed]
+    logger.info("%d items found, %d already completed, %d to process", len(items), len(items) - len(pending), len(pending))
+
+    generator = NarrativeGenerator(ResultCache(), KnowledgeIndex(), host=host)
+    ocr_stage = OCRStage(OCRCache(), ocr_workers)
+    work_queue = queue.Queue(maxsize=max(1, queue_size))
+    manifest_lock = threading.Lock()
+    latencies = []
+    failures = []
+    run_started = time.perf_counter()
+
+    def produce() -> None:
+        for item in pending:
+            try:
+                ocr_stage.load(item)
+            except Exception as e:
+                item.error = f"failed to read inputs: {e}"
+            # Blocks while the queue is full, bounding how far reading runs ahead of generation
+            work_queue.put((item, time.perf_counter()))
+        for _ in range(concurrency):
+            work_queue.put(None)
+
+    def consume() -> None:
+        while True:
+            entry = work_queue.get()
+            if entry is None:
+                return
+            item, queued_at = entry
+            started = time.perf_counter()
+            record = {
+                'id': item.item_id,
+                'input': item.name,
+                'files': [str(path.relative_to(input_dir)) for path in item.files] if input_dir is not None else [],
+                'ocr_seconds': round(item.ocr_seconds, 3),
+            }
+            metrics = RequestMetrics()
+            metrics.record_stage("ocr", item.ocr_seconds)
+            try:
+                if item.error is not None:
+                    raise RuntimeError(item.error)
+                # Parallelism comes from the consumer threads; one request per item keeps the total at --concurrency
+                raw_output = generator.process_multiple_inputs(
+                    item.texts, "combined", concurrency=1, on_stats=metrics.add_inference, use_cache=use_cache,
+                    on_timing=metrics.record_stage
+                )
+                _, _, full_output = format_narrative_output(raw_output)
+                output_path = output_dir / f"{item.name} sred_narrative.txt"
+                output_path.write_text(full_output, encoding="utf-8")
+                record.update(status='ok', output=output_path.name)
+                if item.on_success is not None:
+                    item.on_success()
+            except Exception as e:
+                record.update(status='error', error=str(e))
+            finished = time.perf_counter()
+            record.update(
+                queue_wait_seconds=round(started - queued_at, 3),
+                generation_seconds=round(finished - started, 3),
+                latency_seconds=round(item.ocr_seconds + finished - queued_at, 3),
+                completed_at=datetime.now().isoformat(timespec='seconds'),
+            )
+            metrics.record_stage("total", record['latency_seconds'])
+            record['metrics'] = metrics.to_dict()
+            record_request(record['metrics'], "batch", item=item.name, succeeded=record['status'] == 'ok')
+            with manifest_lock:
+                with manifest_path.open("a", encoding="utf-8") as manifest:
+                    manifest.write(json.dumps(record) + "\n")
+                if record['status'] == 'ok':
+                    latencies.append(record['latency_seconds'])
+                else:
+                    failures.append(item.name)
+            logger.info("%s: %s in %.1fs", item.name, record['status'], record['latency_seconds'])
+
+    threads = [threading.Thread(target=produce, name="batch-reader", daemon=True)]
+    threads += [threading.Thread(target=consume, name=f"batch-generate-{i}", daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    wall_seconds = time.perf_counter() - run_started
+    summary = {
+        'input_dir': str(input_dir) if input_dir is not None else None,
+        'items_total': len(items),
+        'items_skipped': len(items) - len(pending),
+        'items_succeeded': len(latencies),
+        'items_failed': len(failures),
+        'failed_items': failures,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_items_per_minute': round(len(latencies) / wall_seconds * 60, 3) if wall_seconds else 0.0,
+        'latency_seconds': {
+            'mean': round(statistics.mean(latencies), 3),
+            'p50': round(percentile(latencies, 0.5), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'max': round(max(latencies), 3),
+        } if latencies else {},
+        'concurrency': concurrency,
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    (output_dir / SUMMARY_NAME).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+    return summary
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate SR&ED narratives for every input in a directory.")
+    parser.add_argument("input_dir", type=Path, nargs="?", help="Directory of text/image inputs; subdirectories are combined per project")
+    parser.add_argument("--output-dir", type=Path, default=Path("batch_outputs"), help="Where narratives and results.jsonl are written")
+    parser.add_argument("--concurrency", type=int, default=OLLAMA_CONCURRENCY, help="Items generated in parallel (match OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--queue-size", type=int, default=None, help="Items read ahead of generation (default: 2 x concurrency)")
+    parser.add_argument("--ocr-workers", type=int, default=2, help="Images OCRed concurrently within an item")
+    parser.add_argument("--no-cache", action="store_true", help="Regenerate even if an identical request is cached")
+    parser.add_argument("--host", default=None, help="Ollama host (defaults to OLLAMA_HOST or localhost:11434)")
+    git = parser.add_argument_group("git repository input")
+    git.add_argument("--git-repo", type=Path, default=None, help="Also generate a narrative from this repository's commits")
+    git.add_argument("--git-branch", default="HEAD", help="Branch or revision to read")
+    git.add_argument("--since", default=None, help="Only commits after this date (any format git accepts)")
+    git.add_argument("--until", default=None, help="Only commits before this date")
+    git.add_argument("--incremental", action="store_true", help="Only commits added since the last successful run")
+    git.add_argument("--tags", default=",".join(GIT_TAGS), help="Comma-separated SR&ED tags to keep (empty keeps all)")
+    git.add_argument("--ticket-prefixes", default=",".join(GIT_TICKET_PREFIXES), help="Comma-separated ticket prefixes to keep, e.g. RD-")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.input_dir is None and args.git_repo is None:
+        parser.error("give an input directory, --git-repo, or both")
+    if args.input_dir is not None and not args.input_dir.is_dir():
+        parser.error(f"{args.input_dir} is not a directory")
+    extra_items = []
+    if args.git_repo is not None:
+        try:
+            item = git_item(args.git_repo, args.git_branch, args.since, args.until, args.incremental,
+                            split_list(args.tags), split_list(args.ticket_prefixes))
+        except GitIngestError as e:
+            parser.error(str(e))
+        if item is not None:
+            extra_items.append(item)
+    concurrency = max(1, args.concurrency)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    summary = run_batch(
+        args.input_dir,
+        args.output_dir,
+        concurrency=concurrency,
+        queue_size=args.queue_size or 2 * concurrency,
+        ocr_workers=max(1, args.ocr_workers),
+        use_cache=not args.no_cache,
+        host=args.host,
+        extra_items=extra_items,
+    )
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['items_failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
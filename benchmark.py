@@ -0,0 +1,421 @@
+"""
+Offline performance benchmarks.
+
+Usage:
+    python benchmark.py --output benchmark_results.json
+
+Times each stage of the pipeline separately on demo_assets/: image decode,
+EasyOCR readtext, prompt assembly, output formatting of a large response, and
+end-to-end generation. Generation runs against FakeOllamaServer, a local
+stand-in for Ollama's /api/chat that replays demo_assets/outputs at a
+configurable token rate and latency, so no model or network is needed.
+Results are written as JSON and checked against benchmark_thresholds.json
+(and optionally a previous results file); the exit status is 1 on regression.
+"""
+import argparse
+import json
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from chunking import estimate_tokens
+from narrative import NarrativeGenerator, NarrativeStreamParser, format_narrative_output
+from prompting import MODEL_NAME
+from retrieval import KnowledgeIndex
+
+ROOT = Path(__file__).parent
+BENCHMARK_INPUTS = ROOT / "demo_assets" / "inputs"
+BENCHMARK_OUTPUTS = ROOT / "demo_assets" / "outputs"
+THRESHOLDS_PATH = ROOT / "benchmark_thresholds.json"
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg'}
+
+# Whitespace-prefixed words stand in for model tokens when replaying outputs
+PSEUDO_TOKEN = re.compile(r"\s*\S+")
+
+# Smallest slowdown versus a baseline worth reporting, so sub-millisecond stages don't flap
+MIN_REGRESSION_SECONDS = 0.005
+
+# Size of the synthetic response used to time output formatting (copies of the demo outputs)
+FORMAT_OUTPUT_COPIES = 64
+STREAM_CHUNK_CHARS = 16
+
+
+class FakeOllamaServer:
+    """
+    Serves /api/chat like Ollama, replaying canned responses in turn. Each request
+    waits `latency` seconds plus prompt tokens / prefill_rate before the first token,
+    then emits tokens at token_rate per second. Reported durations match the simulated
+    time, so callers can subtract them to measure their own overhead.
+    """
+
+    def __init__(self, responses: list[str], token_rate: float = 200.0, latency: float = 0.1,
+                 prefill_rate: float = 2000.0, host: str = "127.0.0.1", port: int = 0):
+        self.responses = responses
+        self.token_rate = token_rate
+        self.latency = latency
+        self.prefill_rate = prefill_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeOllamaServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_response(self) -> str:
+        with self._lock:
+            response = self.responses[self.requests % len(self.responses)]
+            self.requests += 1
+        return response
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def _send_json(self, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if self.path == "/api/version":
+                    self._send_json({'version': "0.0.0-fake"})
+                elif self.path == "/api/tags":
+                    self._send_json({'models': [{'name': f"{MODEL_NAME}:latest", 'model': f"{MODEL_NAME}:latest"}]})
+                else:
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(b"Ollama is running")
+
+            def do_POST(self) -> None:
+                if self.path != "/api/chat":
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                fake.handle_chat(self, request)
+
+        return Handler
+
+    def _chunk(self, request: dict, content: str, done: bool, **extra) -> dict:
+        return {
+            'model': request.get('model', MODEL_NAME),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'message': {'role': "assistant", 'content': content},
+            'done': done,
+            **extra,
+        }
+
+    def handle_chat(self, handler: BaseHTTPRequestHandler, request: dict) -> None:
+        messages = request.get('messages') or []
+        if not messages:
+            # An empty chat only loads the model
+            handler._send_json(self._chunk(request, "", True, done_reason="load"))
+            return
+
+        prompt_tokens = estimate_tokens("".join(message.get('content', "") for message in messages))
+        tokens = PSEUDO_TOKEN.findall(self._next_response())
+        prefill_seconds = self.latency + prompt_tokens / self.prefill_rate
+        decode_seconds = len(tokens) / self.token_rate
+        stats = {
+            'done_reason': "stop",
+            'total_duration': int((prefill_seconds + decode_seconds) * 1e9),
+            'load_duration': 0,
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prefill_seconds * 1e9),
+            'eval_count': len(tokens),
+            'eval_duration': int(decode_seconds * 1e9),
+        }
+
+        time.sleep(prefill_seconds)
+        if not request.get('stream', True):
+            time.sleep(decode_seconds)
+            handler._send_json(self._chunk(request, "".join(tokens), True, **stats))
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        started = time.perf_counter()
+        for i, token in enumerate(tokens):
+            # Pace against a schedule rather than sleeping per token, so timer overshoot doesn't accumulate
+            delay = started + (i + 1) / self.token_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            handler.wfile.write((json.dumps(self._chunk(request, token, False)) + "\n").encode())
+            handler.wfile.flush()
+        handler.wfile.write((json.dumps(self._chunk(request, "", True, **stats)) + "\n").encode())
+        handler.wfile.flush()
+        handler.close_connection = True
+
+
+def summarize(samples: list[float]) -> dict:
+    """Summary statistics in seconds for one stage."""
+    return {
+        'runs': len(samples),
+        'min': round(min(samples), 6),
+        'median': round(statistics.median(samples), 6),
+        'mean': round(statistics.mean(samples), 6),
+        'max': round(max(samples), 6),
+    }
+
+
+def timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def demo_inputs() -> tuple[list[str], list[Path]]:
+    """Text inputs and image paths from demo_assets/inputs."""
+    texts = []
+    images = []
+    for path in sorted(BENCHMARK_INPUTS.iterdir()):
+        if path.suffix.lower() == '.txt':
+            texts.append(path.read_text(encoding="utf-8"))
+        elif path.suffix.lower() in IMAGE_SUFFIXES:
+            images.append(path)
+    return texts, images
+
+
+def demo_outputs() -> list[str]:
+    return [path.read_text(encoding="utf-8") for path in sorted(BENCHMARK_OUTPUTS.glob("*.txt"))]
+
+
+def bench_image_decode(images: list[Path], repeat: int) -> dict:
+    from ocr_engine import decode_image
+
+    image_bytes = [path.read_bytes() for path in images]
+    # The first decode pays for importing OpenCV/NumPy/PIL; keep that out of the samples
+    decode_image(image_bytes[0])
+    samples = [timed(decode_image, data) for _ in range(repeat) for data in image_bytes]
+    return summarize(samples)
+
+
+def bench_readtext(images: list[Path], repeat: int) -> tuple[dict, dict, list[str]]:
+    """Returns (reader load stats, readtext stats, OCR text per image)."""
+    from ocr_engine import decode_image, get_reader, ocr_image
+
+    started = time.perf_counter()
+    reader = get_reader()
+    load = summarize([time.perf_counter() - started])
+    decoded = [decode_image(path.read_bytes()) for path in images]
+    samples = []
+    texts = []
+    for _ in range(repeat):
+        texts = []
+        for image in decoded:
+            started = time.perf_counter()
+            texts.append(ocr_image(reader, image))
+            samples.append(time.perf_counter() - started)
+    return load, summarize(samples), texts
+
+
+def bench_prompt_assembly(generator: NarrativeGenerator, texts: list[str], repeat: int) -> dict:
+    samples = [timed(generator.narrative_messages, text) for _ in range(repeat) for text in texts]
+    return summarize(samples)
+
+
+def bench_format_output(outputs: list[str], repeat: int) -> tuple[dict, dict, int]:
+    """Times format_narrative_output and the streaming parser on a large synthetic response."""
+    large_output = "\n\n".join(outputs * FORMAT_OUTPUT_COPIES)
+
+    def stream_parse() -> None:
+        parser = NarrativeStreamParser()
+        for i in range(0, len(large_output), STREAM_CHUNK_CHARS):
+            parser.feed(large_output[i:i + STREAM_CHUNK_CHARS])
+        parser.finish()
+
+    whole = summarize([timed(format_narrative_output, large_output) for _ in range(repeat)])
+    streamed = summarize([timed(stream_parse) for _ in range(repeat)])
+    return whole, streamed, len(large_output)
+
+
+def bench_end_to_end(generator: NarrativeGenerator, texts: list[str], repeat: int) -> tuple[dict, dict, dict]:
+    """
+    Streams a narrative for every text through the fake server.
+    Returns stats for total time, time to first chunk, and client-side overhead
+    (total minus the server's simulated prefill and decode time).
+    """
+    totals = []
+    first_chunks = []
+    overheads = []
+    for _ in range(repeat):
+        for text in texts:
+            stats = []
+            first_chunk_at = None
+            started = time.perf_counter()
+
+            def on_chunk(chunk: str) -> None:
+                nonlocal first_chunk_at
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+
+            generator.process_multiple_inputs([text], "combined", on_chunk=on_chunk, on_stats=stats.append, use_cache=False)
+            total = time.perf_counter() - started
+            totals.append(total)
+            first_chunks.append((first_chunk_at or started + total) - started)
+            overheads.append(max(0.0, total - sum(s['total_seconds'] for s in stats)))
+    return summarize(totals), summarize(first_chunks), summarize(overheads)
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(repeat: int, ocr_repeat: int, token_rate: float, latency: float, prefill_rate: float,
+                   skip_ocr: bool = False) -> dict:
+    """Runs every stage and returns the results document (without threshold checks)."""
+    texts, images = demo_inputs()
+    outputs = demo_outputs()
+    stages = {}
+    skipped = {}
+
+    try:
+        stages['image_decode'] = bench_image_decode(images, repeat)
+    except ImportError as e:
+        skipped['image_decode'] = f"missing dependency: {e}"
+
+    if skip_ocr:
+        skipped['ocr_reader_load'] = skipped['ocr_readtext'] = "disabled with --skip-ocr"
+    else:
+        try:
+            stages['ocr_reader_load'], stages['ocr_readtext'], ocr_texts = bench_readtext(images, ocr_repeat)
+            texts += [text for text in ocr_texts if text.strip()]
+        except ImportError as e:
+            skipped['ocr_reader_load'] = skipped['ocr_readtext'] = f"missing dependency: {e}"
+
+    knowledge_index = KnowledgeIndex()
+    offline_generator = NarrativeGenerator(knowledge_index=knowledge_index)
+    stages['prompt_assembly'] = bench_prompt_assembly(offline_generator, texts, repeat)
+    stages['format_output'], stages['format_output_streaming'], output_chars = bench_format_output(outputs, repeat)
+
+    with FakeOllamaServer(outputs, token_rate=token_rate, latency=latency, prefill_rate=prefill_rate) as server:
+        generator = NarrativeGenerator(knowledge_index=knowledge_index, host=server.url)
+        stages['end_to_end'], stages['end_to_end_first_chunk'], stages['end_to_end_overhead'] = bench_end_to_end(generator, texts, repeat)
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'repeat': repeat,
+            'ocr_repeat': ocr_repeat,
+            'token_rate': token_rate,
+            'latency': latency,
+            'prefill_rate': prefill_rate,
+            'text_inputs': len(texts),
+            'image_inputs': len(images),
+            'format_output_chars': output_chars,
+        },
+        'stages': stages,
+        'skipped': skipped,
+    }
+
+
+def check_regressions(results: dict, thresholds: dict, baseline: dict | None = None, tolerance: float = 0.25) -> list[dict]:
+    """
+    Compares each stage's statistic against its absolute limit in thresholds
+    ({stage: {"metric": "median", "max_seconds": x}}) and, when a baseline results
+    document is given, against the baseline value grown by the tolerance fraction.
+    Baseline comparisons are only made when both runs used the same configuration.
+    """
+    checks = []
+    for stage, limit in thresholds.items():
+        if stage not in results['stages']:
+            continue
+        metric = limit.get('metric', 'median')
+        value = results['stages'][stage][metric]
+        checks.append({
+            'stage': stage, 'metric': metric, 'value': value, 'limit': limit['max_seconds'],
+            'source': "threshold", 'passed': value <= limit['max_seconds'],
+        })
+    if baseline is not None and baseline.get('config') == results['config']:
+        for stage, stats in results['stages'].items():
+            previous = baseline.get('stages', {}).get(stage)
+            if previous is None:
+                continue
+            allowed = max(previous['median'] * (1 + tolerance), previous['median'] + MIN_REGRESSION_SECONDS)
+            checks.append({
+                'stage': stage, 'metric': "median", 'value': stats['median'], 'limit': round(allowed, 6),
+                'source': "baseline", 'passed': stats['median'] <= allowed,
+            })
+    return checks
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark each pipeline stage offline against a fake Ollama server.")
+    parser.add_argument("--output", type=Path, default=ROOT / ".cache" / "benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage")
+    parser.add_argument("--ocr-repeat", type=int, default=1, help="Runs of readtext per image (slow on CPU)")
+    parser.add_argument("--skip-ocr", action="store_true", help="Skip loading EasyOCR and timing readtext")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Fake server decode speed in tokens/s")
+    parser.add_argument("--latency", type=float, default=0.1, help="Fake server delay before prefill starts, in seconds")
+    parser.add_argument("--prefill-rate", type=float, default=2000.0, help="Fake server prefill speed in tokens/s")
+    parser.add_argument("--thresholds", type=Path, default=THRESHOLDS_PATH, help="Absolute per-stage limits")
+    parser.add_argument("--baseline", type=Path, default=None, help="Earlier results file to compare medians against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed median slowdown versus the baseline (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        repeat=max(1, args.repeat),
+        ocr_repeat=max(1, args.ocr_repeat),
+        token_rate=args.token_rate,
+        latency=args.latency,
+        prefill_rate=args.prefill_rate,
+        skip_ocr=args.skip_ocr,
+    )
+    thresholds = json.loads(args.thresholds.read_text(encoding="utf-8")) if args.thresholds.exists() else {}
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8")) if args.baseline else None
+    if baseline is not None and baseline.get('config') != results['config']:
+        print("Baseline skipped: it was recorded with a different configuration")
+    results['checks'] = check_regressions(results, thresholds, baseline, args.tolerance)
+    results['passed'] = all(check['passed'] for check in results['checks'])
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<26} median {stats['median'] * 1000:10.2f} ms   max {stats['max'] * 1000:10.2f} ms   ({stats['runs']} runs)")
+    for stage, reason in results['skipped'].items():
+        print(f"{stage:<26} skipped: {reason}")
+    for check in results['checks']:
+        if not check['passed']:
+            print(f"REGRESSION {check['stage']} {check['metric']} {check['value']:.4f}s > {check['limit']:.4f}s ({check['source']})")
+    print(f"Results written to {args.output}")
+    return 0 if results['passed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
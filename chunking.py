@@ -0,0 +1,118 @@
+"""
+Token-aware chunking for work logs larger than the model's context window.
+
+Inputs are split on natural record boundaries (git commits, dated log
+entries, ticket IDs, headings and the "---" separators used in combined mode)
+and packed greedily into chunks that fit the token budget left over after the
+prompt's fixed and retrieved content and the response reserve. Token counts
+are estimated from character length, since the local model exposes no
+tokenizer; the estimate is deliberately conservative.
+"""
+import math
+import re
+
+from prompting import (
+    EVIDENCE_MAX_TOKENS,
+    EVIDENCE_SYSTEM_PROMPT,
+    NARRATIVE_PROMPT_OVERHEAD_CHARS,
+    NUM_CTX,
+    RESPONSE_TOKEN_RESERVE,
+    STATIC_EVIDENCE_PREFIX,
+)
+
+# Conservative characters-per-token ratio for English/code with Qwen-family tokenizers
+CHARS_PER_TOKEN = 3.2
+
+# Lines that start a new record: commits, oneline logs, dated entries, tickets, headings, separators
+RECORD_BOUNDARY = re.compile(
+    r"^(?:commit [0-9a-f]{7,40}\b"
+    r"|\*?\s*[0-9a-f]{7,40} "
+    r"|\d{4}-\d{2}-\d{2}"
+    r"|[A-Z][A-Z0-9]+-\d+\b"
+    r"|#{1,6} "
+    r"|-{3,}\s*$)"
+)
+
+THINKING_BLOCK = re.compile(r"<think>.*?(?:</think>|$)", re.DOTALL)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budget checks."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+# Room left for variable input in a final narrative request and in an evidence extraction request
+NARRATIVE_INPUT_BUDGET = NUM_CTX - math.ceil(NARRATIVE_PROMPT_OVERHEAD_CHARS / CHARS_PER_TOKEN) - RESPONSE_TOKEN_RESERVE
+EVIDENCE_INPUT_BUDGET = NUM_CTX - estimate_tokens(EVIDENCE_SYSTEM_PROMPT + STATIC_EVIDENCE_PREFIX) - EVIDENCE_MAX_TOKENS
+
+
+def split_records(text: str) -> list[str]:
+    """Splits text into records at commit/ticket/entry boundaries, preserving every line."""
+    records = []
+    current = []
+    for line in text.splitlines():
+        if current and RECORD_BOUNDARY.match(line):
+            records.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        records.append("\n".join(current))
+    return records
+
+
+def _split_oversized(record: str, max_tokens: int) -> list[str]:
+    """Breaks a single record that exceeds the budget by lines, then by characters."""
+    max_chars = max(1, int(max_tokens * CHARS_PER_TOKEN))
+    pieces = []
+    current = ""
+    for line in record.splitlines():
+        while len(line) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > max_chars:
+            pieces.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_into_chunks(text: str, max_tokens: int) -> list[str]:
+    """
+    Packs records into as few chunks as possible, each estimated at no more than max_tokens.
+    Text already within budget is returned as a single chunk unchanged.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for record in split_records(text):
+        record_tokens = estimate_tokens(record) + 1
+        if record_tokens > max_tokens:
+            pieces = _split_oversized(record, max_tokens)
+        else:
+            pieces = [record]
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece) + 1
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def strip_thinking(text: str) -> str:
+    """Removes <think>...</think> reasoning blocks from a model response."""
+    return THINKING_BLOCK.sub("", text).strip()
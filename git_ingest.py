@@ -0,0 +1,293 @@
+"""
+Git repository ingestion.
+
+Reads commits straight from a local repository with `git log`, so work logs no
+longer have to be screenshotted and OCRed. Commits are streamed from the git
+process (oldest first) and filtered as they arrive: merge commits are dropped,
+a revert and the commit it reverts cancel out, copies of the same change
+(rebases, cherry-picks: same message and same `git patch-id`) are kept once, and when SR&ED tags or ticket prefixes are given
+only commits mentioning one of them are kept. The result is formatted like
+`git log` output ("commit <sha>" records), which chunking.py splits on.
+
+A checkpoint file remembers the last commit processed per repository and
+branch, so incremental runs only read commits added since then. When more
+commits match than a run may use, the oldest are used and the checkpoint stops
+after the last of them, so the next incremental run picks up the rest.
+"""
+import json
+import os
+import re
+import subprocess
+import threading
+import uuid
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+def split_list(value: str) -> list[str]:
+    """Parses a comma-separated setting, dropping blanks."""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+GIT_CHECKPOINT_PATH = Path(os.environ.get("SRED_GIT_CHECKPOINT_PATH", Path(__file__).parent / ".cache" / "git_checkpoints.json"))
+
+# Default commit filters; comma-separated, empty keeps every commit
+GIT_TAGS = split_list(os.environ.get("SRED_GIT_TAGS", "SR&ED,SRED"))
+GIT_TICKET_PREFIXES = split_list(os.environ.get("SRED_GIT_TICKET_PREFIXES", ""))
+
+# Upper bound on commits per read, keeping the prompt (and map-reduce) bounded
+GIT_MAX_COMMITS = int(os.environ.get("SRED_GIT_MAX_COMMITS", "500"))
+
+RECORD_START = "\x1e"
+FIELD_SEPARATOR = "\x1f"
+LOG_FORMAT = "%x1e%H%x1f%P%x1f%an%x1f%ad%x1f%s%x1f%b"
+REVERT_TRAILER = re.compile(r"This reverts commit ([0-9a-f]{7,40})")
+CHERRY_PICK_TRAILER = re.compile(r"\(cherry picked from commit [0-9a-f]{7,40}\)\s*")
+
+
+class GitIngestError(RuntimeError):
+    """Raised when a repository cannot be read."""
+
+
+@dataclass
+class Commit:
+    sha: str
+    parents: list[str]
+    author: str
+    date: str
+    subject: str
+    body: str
+
+    @property
+    def is_merge(self) -> bool:
+        return len(self.parents) > 1
+
+    @property
+    def reverted_sha(self) -> str | None:
+        """The commit this one reverts, from git's standard revert message."""
+        if not self.subject.startswith("Revert "):
+            return None
+        match = REVERT_TRAILER.search(self.body)
+        return match.group(1) if match else None
+
+    @property
+    def message(self) -> str:
+        return f"{self.subject}\n\n{self.body}".strip()
+
+    def format(self) -> str:
+        message = "\n".join(f"    {line}" if line else "" for line in self.message.splitlines())
+        return f"commit {self.sha}\nAuthor: {self.author}\nDate:   {self.date}\n\n{message}"
+
+
+@dataclass
+class GitIngestResult:
+    text: str
+    commits: list[Commit]
+    head: str
+    revision_range: str
+    skipped: dict[str, int] = field(default_factory=dict)
+    # True when max_commits cut the read short; `head` is then the last commit read, not the branch head
+    truncated: bool = False
+
+
+def run_git(repo: Path, *args: str, input: str | None = None) -> str:
+    try:
+        completed = subprocess.run(["git", "-C", str(repo), *args], input=input, capture_output=True, text=True, check=True)
+    except FileNotFoundError as e:
+        raise GitIngestError("git is not installed or not on PATH") from e
+    except subprocess.CalledProcessError as e:
+        raise GitIngestError(f"git {args[0]} failed in {repo}: {e.stderr.strip()}") from e
+    return completed.stdout
+
+
+def resolve_revision(repo: Path, revision: str) -> str | None:
+    """Full sha of a revision, or None if it doesn't exist in the repository."""
+    try:
+        return run_git(repo, "rev-parse", "--verify", "--quiet", f"{revision}^{{commit}}").strip() or None
+    except GitIngestError:
+        return None
+
+
+def patch_id(repo: Path, sha: str) -> str | None:
+    """Hash of a commit's diff (`git patch-id`), equal for rebased or cherry-picked copies; None for an empty diff."""
+    diff = run_git(repo, "show", "--no-color", "--format=", sha)
+    output = run_git(repo, "patch-id", "--stable", input=diff).split()
+    return output[0] if output else None
+
+
+def _parse_record(record: str) -> Commit:
+    sha, parents, author, date, subject, body = record.split(FIELD_SEPARATOR, 5)
+    return Commit(sha, parents.split(), author, date, subject.strip(), body.strip())
+
+
+def iter_commits(repo: Path, revision_range: str = "HEAD", since: str | None = None, until: str | None = None) -> Iterator[Commit]:
+    """Yields commits oldest first (parents before children) as `git log` produces them."""
+    command = ["git", "-C", str(repo), "log", "--topo-order", "--reverse", "--no-color", "--date=iso-strict", f"--format={LOG_FORMAT}"]
+    if since:
+        command.append(f"--since={since}")
+    if until:
+        command.append(f"--until={until}")
+    command += [revision_range, "--"]
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   encoding="utf-8", errors="replace")
+    except FileNotFoundError as e:
+        raise GitIngestError("git is not installed or not on PATH") from e
+
+    try:
+        record = None
+        for line in process.stdout:
+            if line.startswith(RECORD_START):
+                if record is not None:
+                    yield _parse_record(record)
+                record = line[1:]
+            elif record is not None:
+                record += line
+        if record is not None:
+            yield _parse_record(record)
+        if process.wait() != 0:
+            raise GitIngestError(f"git log failed in {repo}: {process.stderr.read().strip()}")
+    finally:
+        # Stops git early when the caller has seen enough commits
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def commit_filter(tags: list[str], ticket_prefixes: list[str]):
+    """Predicate keeping commits that mention any tag or ticket id; keeps everything when both are empty."""
+    patterns = [re.escape(tag) for tag in tags] + [re.escape(prefix) + r"\d+" for prefix in ticket_prefixes]
+    if not patterns:
+        return lambda commit: True
+    pattern = re.compile("|".join(patterns), re.IGNORECASE)
+    return lambda commit: pattern.search(commit.message) is not None
+
+
+def select_commits(commits: Iterator[Commit], tags: list[str], ticket_prefixes: list[str],
+                   max_commits: int = GIT_MAX_COMMITS, skipped: dict[str, int] | None = None,
+                   patch_id=None) -> tuple[list[Commit], str | None]:
+    """
+    Applies merge/revert/duplicate removal and the tag filter to an oldest-first
+    commit stream, stopping once max_commits are selected. A commit is a duplicate
+    when an earlier one has the same message and patch_id(sha) returns the same
+    diff hash for both; without patch_id no commits are treated as duplicates.
+    Counts of dropped commits by reason are added to `skipped`. Returns the
+    selected commits and, when more commits remained unread, the sha of the last
+    commit read (the point up to which the range has been processed), otherwise None.
+    """
+    commits = iter(commits)
+    skipped = skipped if skipped is not None else {}
+    matches = commit_filter(tags, ticket_prefixes)
+    # Message -> earlier commits with that message; diffs are only hashed on a message collision
+    seen_messages: dict[str, list[str]] = {}
+    diff_hashes: dict[str, str | None] = {}
+    selected = []
+
+    def diff_hash(sha: str) -> str | None:
+        if sha not in diff_hashes:
+            diff_hashes[sha] = patch_id(sha)
+        return diff_hashes[sha]
+
+    def skip(reason: str) -> None:
+        skipped[reason] = skipped.get(reason, 0) + 1
+
+    for commit in commits:
+        if commit.is_merge:
+            skip("merges")
+            continue
+        # Oldest first, so the commit a revert undoes has already been selected (if it is in range)
+        if commit.reverted_sha is not None:
+            skip("reverts")
+            kept = [c for c in selected if not c.sha.startswith(commit.reverted_sha)]
+            if len(kept) < len(selected):
+                skip("reverted")
+                selected = kept
+            continue
+        message_key = CHERRY_PICK_TRAILER.sub("", commit.message).strip()
+        earlier = seen_messages.setdefault(message_key, [])
+        if patch_id is not None and earlier and diff_hash(commit.sha) is not None:
+            if any(diff_hash(sha) == diff_hash(commit.sha) for sha in earlier):
+                skip("duplicates")
+                continue
+        earlier.append(commit.sha)
+        if not matches(commit):
+            skip("unmatched")
+            continue
+        selected.append(commit)
+        if len(selected) >= max_commits:
+            return selected, commit.sha if next(commits, None) is not None else None
+    return selected, None
+
+
+def format_commits(repo: Path, commits: list[Commit], revision_range: str) -> str:
+    """Commits oldest first in `git log` layout, under a one-line header."""
+    header = f"Git history of {repo.name} ({len(commits)} commits, {revision_range})"
+    return "\n\n".join([header] + [commit.format() for commit in commits])
+
+
+class GitCheckpoints:
+    """Last processed commit per (repository, branch), persisted as JSON."""
+
+    def __init__(self, path: Path = GIT_CHECKPOINT_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(repo: Path, branch: str) -> str:
+        return f"{Path(repo).expanduser().resolve()}#{branch}"
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, repo: Path, branch: str) -> str | None:
+        with self._lock:
+            return self._load().get(self._key(repo, branch))
+
+    def set(self, repo: Path, branch: str, sha: str) -> None:
+        with self._lock:
+            checkpoints = self._load()
+            checkpoints[self._key(repo, branch)] = sha
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_text(json.dumps(checkpoints, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+
+
+def read_repository(repo: Path, branch: str = "HEAD", since: str | None = None, until: str | None = None,
+                    incremental: bool = False, tags: list[str] = GIT_TAGS, ticket_prefixes: list[str] = GIT_TICKET_PREFIXES,
+                    checkpoints: GitCheckpoints | None = None, max_commits: int = GIT_MAX_COMMITS) -> GitIngestResult:
+    """
+    Reads, filters and formats the commits on `branch`, optionally limited to a date
+    range (any date git accepts) and, when incremental, to commits after the stored
+    checkpoint. At most max_commits are used, oldest first; when that cuts the read
+    short, result.truncated is set and result.head is the last commit read. The
+    checkpoint is not advanced here: call checkpoints.set(repo, branch, result.head)
+    once the text has been used successfully.
+    """
+    repo = Path(repo).expanduser()
+    if not repo.is_dir():
+        raise GitIngestError(f"{repo} is not a directory")
+    # Raises with git's own message when this is not a repository
+    run_git(repo, "rev-parse", "--git-dir")
+    head = resolve_revision(repo, branch)
+    if head is None:
+        raise GitIngestError(f"{branch} is not a commit in {repo}")
+
+    revision_range = branch
+    if incremental and checkpoints is not None:
+        last = checkpoints.get(repo, branch)
+        # A checkpoint that was rewritten away (force push, gc) falls back to the full range
+        if last is not None and resolve_revision(repo, last) is not None:
+            revision_range = f"{last}..{branch}"
+
+    skipped = {}
+    commits, stopped_at = select_commits(iter_commits(repo, revision_range, since, until), tags, ticket_prefixes,
+                                         max_commits, skipped, patch_id=lambda sha: patch_id(repo, sha))
+    text = format_commits(repo, commits, revision_range) if commits else ""
+    return GitIngestResult(text=text, commits=commits, head=stopped_at or head, revision_range=revision_range,
+                           skipped=skipped, truncated=stopped_at is not None)
@@ -0,0 +1,99 @@
+"""
+Persistent narrative history, stored in SQLite.
+
+Each generated narrative is saved with small metadata columns (timestamp, a
+one-line title, input count, size, metrics) and its body zlib-compressed in a
+separate column. Listing a page of history reads only the metadata; a body is
+decompressed only when that entry is opened. The table is trimmed to a
+maximum number of entries, oldest first.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+HISTORY_PATH = Path(os.environ.get("SRED_HISTORY_PATH", Path(__file__).parent / ".cache" / "history.sqlite3"))
+HISTORY_PAGE_SIZE = int(os.environ.get("SRED_HISTORY_PAGE_SIZE", "10"))
+HISTORY_MAX_ENTRIES = int(os.environ.get("SRED_HISTORY_MAX_ENTRIES", "1000"))
+
+TITLE_MAX_CHARS = 80
+
+
+def narrative_title(narrative: str) -> str:
+    """First line of prose in a narrative (skipping headings and rules), shortened for listings."""
+    for line in narrative.splitlines():
+        line = line.strip().lstrip("*-• ").strip()
+        if line and not line.startswith(("#", "---", "===")):
+            return line if len(line) <= TITLE_MAX_CHARS else line[:TITLE_MAX_CHARS - 1].rstrip() + "…"
+    return "Untitled narrative"
+
+
+class HistoryStore:
+    """SQLite-backed history with compressed bodies and metadata-only paging. Safe to share across threads."""
+
+    def __init__(self, path: Path = HISTORY_PATH, max_entries: int = HISTORY_MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, title TEXT NOT NULL, "
+                "input_count INTEGER NOT NULL, output_chars INTEGER NOT NULL, metrics TEXT, body BLOB NOT NULL)"
+            )
+
+    def add(self, narrative: str, input_count: int, metrics: dict | None = None) -> int:
+        """Saves a narrative and returns its id, then trims the oldest entries beyond max_entries."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO history (created_at, title, input_count, output_chars, metrics, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    narrative_title(narrative),
+                    input_count,
+                    len(narrative),
+                    json.dumps(metrics) if metrics is not None else None,
+                    zlib.compress(narrative.encode("utf-8")),
+                )
+            )
+            self._conn.execute(
+                "DELETE FROM history WHERE id IN (SELECT id FROM history ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            return cursor.lastrowid
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def page(self, page: int, page_size: int = HISTORY_PAGE_SIZE) -> list[dict]:
+        """Metadata for one page of entries, newest first; bodies are not read."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, created_at, title, input_count, output_chars, metrics FROM history "
+                "ORDER BY id DESC LIMIT ? OFFSET ?",
+                (page_size, max(0, page) * page_size)
+            ).fetchall()
+        return [
+            {
+                'id': entry_id,
+                'timestamp': datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S'),
+                'title': title,
+                'input_count': input_count,
+                'output_chars': output_chars,
+                'metrics': json.loads(metrics) if metrics else None,
+            }
+            for entry_id, created_at, title, input_count, output_chars, metrics in rows
+        ]
+
+    def narrative(self, entry_id: int) -> str | None:
+        """Decompresses and returns one entry's narrative, or None if it no longer exists."""
+        with self._lock:
+            row = self._conn.execute("SELECT body FROM history WHERE id = ?", (entry_id,)).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row is not None else None
@@ -0,0 +1,383 @@
+"""
+Background generation jobs spread over a pool of Ollama endpoints.
+
+JobQueue accepts generation requests, records them in SQLite and runs them on
+background worker threads, so a Streamlit rerun or browser refresh no longer
+discards in-flight work: the page just polls the job by id. Workers write
+progress, streamed output and notes to the job row as they go, and on success
+save the narrative to the history store themselves.
+
+EndpointPool schedules jobs across the Ollama hosts in SRED_OLLAMA_HOSTS
+(comma-separated, each optionally suffixed with "=<requests>" for the most
+concurrent Ollama requests it may receive, e.g.
+"http://127.0.0.1:11434=2,http://127.0.0.1:11435"). A job takes as many slots
+on the least-loaded healthy endpoint as it can actually use (one for a combined
+input that fits the prompt budget), up to its requested concurrency, and never
+sends more requests at once than it holds slots. Endpoints are health-checked
+in the background and immediately after a failed job. When the failing endpoint
+turns out to be down, the job is retried on another one; when no healthy
+endpoint is left, it fails.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from git_ingest import GitCheckpoints
+from history_store import HistoryStore
+from metrics import RequestMetrics, record_request
+from narrative import (
+    OLLAMA_CONCURRENCY,
+    NarrativeGenerationError,
+    NarrativeGenerator,
+    format_narrative_output,
+    parallel_requests,
+)
+from result_cache import ResultCache
+from retrieval import KnowledgeIndex
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_PATH = Path(os.environ.get("SRED_JOB_DB_PATH", Path(__file__).parent / ".cache" / "jobs.sqlite3"))
+
+# Queue generations on background workers by default (SRED_BACKGROUND_JOBS=0 runs them in the page)
+BACKGROUND_JOBS_DEFAULT = os.environ.get("SRED_BACKGROUND_JOBS", "1") != "0"
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get("SRED_HEALTH_CHECK_INTERVAL", "15"))
+HEALTH_CHECK_TIMEOUT = 3.0
+# Attempts per job, each on a different endpoint when the previous one went down
+JOB_MAX_ATTEMPTS = 3
+# Finished jobs older than this are deleted on startup
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+# Minimum seconds between writes of streamed output to the job row
+PARTIAL_FLUSH_INTERVAL = 0.5
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def parse_hosts(value: str, default_concurrency: int) -> list[tuple[str, int]]:
+    """Parses "host[=requests],host[=requests]" into (host, concurrency) pairs."""
+    hosts = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, limit = item.rpartition("=") if "=" in item else (item, "", "")
+        hosts.append((host.strip(), max(1, int(limit)) if limit else default_concurrency))
+    return hosts
+
+
+OLLAMA_ENDPOINTS = parse_hosts(
+    os.environ.get("SRED_OLLAMA_HOSTS", os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")),
+    max(1, OLLAMA_CONCURRENCY),
+)
+
+
+@dataclass
+class Endpoint:
+    host: str
+    max_concurrency: int
+    in_flight: int = 0
+    healthy: bool = True
+    last_error: str | None = None
+    last_checked: float = 0.0
+
+    @property
+    def url(self) -> str:
+        return self.host if "://" in self.host else f"http://{self.host}"
+
+
+class EndpointPool:
+    """Hands out endpoint slots, least-loaded healthy endpoint first, and tracks endpoint health."""
+
+    def __init__(self, endpoints: list[tuple[str, int]] = OLLAMA_ENDPOINTS):
+        self.endpoints = [Endpoint(host, limit) for host, limit in endpoints]
+        self._condition = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return sum(endpoint.max_concurrency for endpoint in self.endpoints)
+
+    def acquire(self, slots: int = 1, exclude: set[str] = frozenset()) -> tuple[Endpoint, int] | None:
+        """
+        Blocks until a healthy endpoint outside `exclude` (hosts that already failed
+        this job) has a free slot, then takes up to `slots` of its free slots and
+        returns (endpoint, slots taken). Returns None as soon as no healthy endpoint
+        outside `exclude` is left, rather than waiting for one to come back.
+        """
+        with self._condition:
+            while True:
+                healthy = [e for e in self.endpoints if e.healthy and e.host not in exclude]
+                if not healthy:
+                    return None
+                free = [e for e in healthy if e.in_flight < e.max_concurrency]
+                if free:
+                    endpoint = min(free, key=lambda e: e.in_flight / e.max_concurrency)
+                    taken = max(1, min(slots, endpoint.max_concurrency - endpoint.in_flight))
+                    endpoint.in_flight += taken
+                    return endpoint, taken
+                # Woken by release() and by health changes
+                self._condition.wait()
+
+    def release(self, endpoint: Endpoint, slots: int = 1) -> None:
+        with self._condition:
+            endpoint.in_flight -= slots
+            self._condition.notify_all()
+
+    def check(self, endpoint: Endpoint) -> bool:
+        """Pings the endpoint's /api/version and records whether it answered."""
+        try:
+            with urllib.request.urlopen(f"{endpoint.url}/api/version", timeout=HEALTH_CHECK_TIMEOUT) as response:
+                healthy = response.status == 200
+                error = None if healthy else f"HTTP {response.status}"
+        except OSError as e:
+            healthy, error = False, str(e)
+        with self._condition:
+            if healthy != endpoint.healthy:
+                logger.warning("Ollama endpoint %s is now %s", endpoint.host, "healthy" if healthy else f"down: {error}")
+            endpoint.healthy = healthy
+            endpoint.last_error = error
+            endpoint.last_checked = time.time()
+            self._condition.notify_all()
+        return healthy
+
+    def check_all(self) -> None:
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+
+    def run_health_checks(self, interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        """Checks every endpoint forever; run on a daemon thread."""
+        while True:
+            self.check_all()
+            time.sleep(interval)
+
+    def status(self) -> list[dict]:
+        with self._condition:
+            return [
+                {'host': e.host, 'healthy': e.healthy, 'in_flight': e.in_flight,
+                 'max_concurrency': e.max_concurrency, 'last_error': e.last_error}
+                for e in self.endpoints
+            ]
+
+
+@dataclass
+class JobRequest:
+    source_texts: list[str]
+    mode: str = "combined"
+    concurrency: int = 1
+    use_cache: bool = True
+    # Stage timings measured before queueing (OCR, git), included in the job's metrics
+    stages: dict[str, float] = field(default_factory=dict)
+    # (repository, branch, head) to checkpoint once the narrative succeeds
+    git_checkpoint: tuple[str, str, str] | None = None
+
+
+class JobStore:
+    """SQLite table of jobs: request, status, progress, streamed output and result. Safe to share across threads."""
+
+    def __init__(self, path: Path = JOB_DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL, status TEXT NOT NULL, "
+                "request TEXT NOT NULL, endpoint TEXT, attempts INTEGER NOT NULL DEFAULT 0, progress TEXT, "
+                "notes TEXT NOT NULL DEFAULT '[]', partial TEXT NOT NULL DEFAULT '', result TEXT, error TEXT, "
+                "metrics TEXT, history_id INTEGER)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def create(self, request: JobRequest) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, created_at, updated_at, status, request) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, now, now, json.dumps(request.__dict__))
+            )
+        return job_id
+
+    def update(self, job_id: str, **columns) -> None:
+        for name in ('progress', 'notes', 'metrics'):
+            if name in columns and not isinstance(columns[name], str):
+                columns[name] = json.dumps(columns[name])
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                (*columns.values(), time.time(), job_id)
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            names = [column[0] for column in cursor.description]
+        if row is None:
+            return None
+        job = dict(zip(names, row))
+        job['request'] = json.loads(job['request'])
+        job['notes'] = json.loads(job['notes'])
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        job['metrics'] = json.loads(job['metrics']) if job['metrics'] else None
+        return job
+
+    def queue_position(self, job_id: str) -> int:
+        """1-based position among queued jobs, or 0 if the job isn't queued."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= "
+                "(SELECT created_at FROM jobs WHERE id = ? AND status = 'queued')",
+                (job_id,)
+            ).fetchone()
+        return row[0]
+
+    def recover(self) -> list[str]:
+        """Requeues jobs left queued or running by a previous process and returns their ids, oldest first."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND updated_at < ?",
+                               (time.time() - JOB_RETENTION_SECONDS,))
+            self._conn.execute("UPDATE jobs SET status = 'queued', partial = '', progress = NULL WHERE status = 'running'")
+            rows = self._conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall()
+        return [row[0] for row in rows]
+
+
+class JobQueue:
+    """Runs queued generation jobs on worker threads against an EndpointPool."""
+
+    def __init__(self, pool: EndpointPool, store: JobStore | None = None, result_cache: ResultCache | None = None,
+                 knowledge_index: KnowledgeIndex | None = None, history_store: HistoryStore | None = None,
+                 git_checkpoints: GitCheckpoints | None = None, workers: int | None = None):
+        self.pool = pool
+        self.store = store or JobStore()
+        self.result_cache = result_cache
+        self.knowledge_index = knowledge_index
+        self.history_store = history_store
+        self.git_checkpoints = git_checkpoints
+        # One worker per endpoint slot keeps every slot busy without oversubscribing
+        self.workers = workers or pool.capacity
+        self._pending = queue.Queue()
+        self._started = False
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        for job_id in self.store.recover():
+            self._pending.put(job_id)
+        threading.Thread(target=self.pool.run_health_checks, name="ollama-health", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, request: JobRequest) -> str:
+        job_id = self.store.create(request)
+        self._pending.put(job_id)
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        return self.store.get(job_id)
+
+    def _work(self) -> None:
+        while True:
+            job_id = self._pending.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.exception("Job %s crashed", job_id)
+                self.store.update(job_id, status="failed", error=f"Internal error: {e}")
+
+    def _run(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        if job is None or job['status'] not in ACTIVE_STATUSES:
+            return
+        request = JobRequest(**job['request'])
+        notes = []
+        failed_hosts = set()
+        last_error = None
+
+        def notify(level: str, message: str) -> None:
+            notes.append({'level': level, 'message': message})
+            self.store.update(job_id, notes=notes)
+
+        # Reserve only the slots this job can use, leaving the rest of the endpoint to other jobs
+        wanted = parallel_requests(request.source_texts, request.mode, request.concurrency)
+        for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+            lease = self.pool.acquire(wanted, exclude=failed_hosts)
+            if lease is None:
+                hosts = ", ".join(f"{status['host']} ({status['last_error']})" for status in self.pool.status())
+                self.store.update(job_id, status="failed", endpoint=None,
+                                  error=last_error or f"No healthy Ollama endpoint: {hosts}. Check Ollama connection.")
+                return
+            endpoint, slots = lease
+            metrics = RequestMetrics()
+            for stage, seconds in request.stages.items():
+                metrics.record_stage(stage, seconds)
+            self.store.update(job_id, status="running", endpoint=endpoint.host, attempts=attempt, partial="", progress=None)
+            try:
+                # Never more requests in flight than slots held on this endpoint
+                result = self._generate(job_id, request, endpoint, slots, notify, metrics)
+            except NarrativeGenerationError as e:
+                last_error = str(e)
+                # Fail over only if the endpoint itself is down; otherwise the request is at fault
+                if not self.pool.check(endpoint) and attempt < JOB_MAX_ATTEMPTS:
+                    failed_hosts.add(endpoint.host)
+                    notify("warning", f"⚠️ Ollama at {endpoint.host} stopped responding; looking for another endpoint.")
+                    self.store.update(job_id, status="queued", endpoint=None)
+                    continue
+                self.store.update(job_id, status="failed", error=last_error, metrics=metrics.finish())
+                return
+            finally:
+                self.pool.release(endpoint, slots)
+
+            metrics_dict = metrics.finish()
+            record_request(metrics_dict, "job", job=job_id, endpoint=endpoint.host, mode=request.mode,
+                           inputs=len(request.source_texts), succeeded=bool(result))
+            history_id = None
+            if result and self.history_store is not None:
+                _, formatted_narrative, _ = format_narrative_output(result)
+                history_id = self.history_store.add(formatted_narrative, len(request.source_texts), metrics_dict)
+            if result and request.git_checkpoint is not None and self.git_checkpoints is not None:
+                repo, branch, head = request.git_checkpoint
+                self.git_checkpoints.set(Path(repo), branch, head)
+            self.store.update(
+                job_id,
+                status="done" if result else "failed",
+                result=result,
+                partial=result,
+                error=None if result else "The model returned an empty response.",
+                metrics=metrics_dict,
+                history_id=history_id,
+            )
+            return
+
+    def _generate(self, job_id: str, request: JobRequest, endpoint: Endpoint, concurrency: int, notify,
+                  metrics: RequestMetrics) -> str:
+        pieces = []
+        last_flush = 0.0
+
+        def on_chunk(chunk: str) -> None:
+            nonlocal last_flush
+            pieces.append(chunk)
+            if time.monotonic() - last_flush >= PARTIAL_FLUSH_INTERVAL:
+                self.store.update(job_id, partial="".join(pieces))
+                last_flush = time.monotonic()
+
+        def on_progress(stage: str, done: int, total: int) -> None:
+            self.store.update(job_id, progress={'stage': stage, 'done': done, 'total': total})
+
+        generator = NarrativeGenerator(self.result_cache, self.knowledge_index, host=endpoint.url,
+                                       notify=notify, on_progress=on_progress)
+        return generator.process_multiple_inputs(
+            request.source_texts, request.mode, on_chunk=on_chunk, concurrency=concurrency,
+            on_stats=metrics.add_inference, use_cache=request.use_cache, on_timing=metrics.record_stage
+        )
@@ -0,0 +1,188 @@
+"""
+Per-request stage timings and inference metrics.
+
+RequestMetrics collects the wall-clock time spent in each pipeline stage (OCR,
+prompt assembly, evidence extraction, generation) and the token accounting
+Ollama returns for every chat request, from which prefill and decode tokens/s
+are derived. Finished requests are logged as one JSON line on the
+"sred.metrics" logger and added to process-wide totals that MetricsRegistry
+renders in the Prometheus text format, served on SRED_METRICS_PORT when set.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port for the Prometheus-style /metrics endpoint; 0 disables it
+METRICS_PORT = int(os.environ.get("SRED_METRICS_PORT", "0"))
+
+# Display order for stages; unknown stages are listed after these
+STAGE_ORDER = ("git", "ocr", "evidence", "prompt_assembly", "generation", "total")
+
+logger = logging.getLogger("sred.metrics")
+if not logger.handlers:
+    # One bare JSON object per line, independent of how the host app configures logging
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class RequestMetrics:
+    """Timings and Ollama token accounting for one user request. Callbacks may run on any thread."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.inferences: list[dict] = []
+        self._lock = threading.Lock()
+
+    def record_stage(self, stage: str, seconds: float) -> None:
+        """Adds seconds to a stage; a stage reported several times accumulates."""
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def add_inference(self, stats: dict) -> None:
+        """on_stats callback for NarrativeGenerator: one prompt_eval_stats dict per Ollama request."""
+        with self._lock:
+            self.inferences.append(stats)
+
+    def finish(self) -> dict:
+        """Records the total wall time and returns the metrics as a JSON-serialisable dict."""
+        self.record_stage("total", time.perf_counter() - self.started)
+        return self.to_dict()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            inferences = list(self.inferences)
+            stages = dict(self.stages)
+            counts = dict(self.counts)
+        prompt_tokens = sum(s['prompt_eval_count'] for s in inferences)
+        prompt_seconds = sum(s['prompt_eval_seconds'] for s in inferences)
+        eval_tokens = sum(s['eval_count'] for s in inferences)
+        eval_seconds = sum(s['eval_seconds'] for s in inferences)
+        ordered = sorted(stages, key=lambda stage: STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER))
+        return {
+            'stages': {stage: round(stages[stage], 3) for stage in ordered},
+            'counts': counts,
+            'ollama_requests': len(inferences),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_seconds': round(prompt_seconds, 3),
+            'eval_count': eval_tokens,
+            'eval_seconds': round(eval_seconds, 3),
+            'load_seconds': round(sum(s['load_seconds'] for s in inferences), 3),
+            'prompt_tokens_per_second': round(prompt_tokens / prompt_seconds, 1) if prompt_seconds else 0.0,
+            'eval_tokens_per_second': round(eval_tokens / eval_seconds, 1) if eval_seconds else 0.0,
+            'requests': [
+                {key: round(value, 3) if isinstance(value, float) else value for key, value in s.items()}
+                for s in inferences
+            ],
+        }
+
+
+def format_metrics(metrics: dict) -> str:
+    """One-line summary of RequestMetrics.to_dict output."""
+    stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in metrics['stages'].items())
+    if not metrics['ollama_requests']:
+        return stages
+    return (
+        f"{stages} | prefill {metrics['prompt_eval_count']} tok @ {metrics['prompt_tokens_per_second']:.0f} tok/s, "
+        f"decode {metrics['eval_count']} tok @ {metrics['eval_tokens_per_second']:.1f} tok/s"
+    )
+
+
+class MetricsRegistry:
+    """Process-wide totals over finished requests, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests_total: dict[str, int] = {}
+        self.stage_seconds: dict[str, float] = {}
+        self.stage_count: dict[str, int] = {}
+        self.token_totals = {'prompt': 0, 'generated': 0}
+        self.token_seconds = {'prompt': 0.0, 'generated': 0.0}
+        self.last_tokens_per_second = {'prompt': 0.0, 'generated': 0.0}
+
+    def observe(self, metrics: dict, source: str) -> None:
+        with self._lock:
+            self.requests_total[source] = self.requests_total.get(source, 0) + 1
+            for stage, seconds in metrics['stages'].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+                self.stage_count[stage] = self.stage_count.get(stage, 0) + 1
+            self.token_totals['prompt'] += metrics['prompt_eval_count']
+            self.token_totals['generated'] += metrics['eval_count']
+            self.token_seconds['prompt'] += metrics['prompt_eval_seconds']
+            self.token_seconds['generated'] += metrics['eval_seconds']
+            if metrics['ollama_requests']:
+                self.last_tokens_per_second = {
+                    'prompt': metrics['prompt_tokens_per_second'],
+                    'generated': metrics['eval_tokens_per_second'],
+                }
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP sred_requests_total Narrative requests completed.",
+                "# TYPE sred_requests_total counter",
+                *(f'sred_requests_total{{source="{source}"}} {count}' for source, count in self.requests_total.items()),
+                "# HELP sred_stage_seconds Wall-clock seconds spent per pipeline stage.",
+                "# TYPE sred_stage_seconds summary",
+            ]
+            for stage, seconds in self.stage_seconds.items():
+                lines.append(f'sred_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+                lines.append(f'sred_stage_seconds_count{{stage="{stage}"}} {self.stage_count[stage]}')
+            lines += [
+                "# HELP sred_tokens_total Tokens processed by Ollama.",
+                "# TYPE sred_tokens_total counter",
+                *(f'sred_tokens_total{{kind="{kind}"}} {count}' for kind, count in self.token_totals.items()),
+                "# HELP sred_token_seconds_total Seconds Ollama spent on prefill (prompt) and decode (generated).",
+                "# TYPE sred_token_seconds_total counter",
+                *(f'sred_token_seconds_total{{kind="{kind}"}} {seconds:.6f}' for kind, seconds in self.token_seconds.items()),
+                "# HELP sred_last_tokens_per_second Throughput of the most recent request.",
+                "# TYPE sred_last_tokens_per_second gauge",
+                *(f'sred_last_tokens_per_second{{kind="{kind}"}} {rate}' for kind, rate in self.last_tokens_per_second.items()),
+            ]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def record_request(metrics: dict, source: str, **fields) -> None:
+    """Logs a finished request as one JSON line and adds it to the process-wide registry."""
+    registry.observe(metrics, source)
+    entry = {'event': "sred_request", 'source': source, **fields, **{k: v for k, v in metrics.items() if k != 'requests'}}
+    logger.info(json.dumps(entry))
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves registry.render() at /metrics on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
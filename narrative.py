@@ -0,0 +1,497 @@
+"""
+SR&ED narrative generation pipeline, independent of the Streamlit UI.
+
+NarrativeGenerator wraps the Ollama client together with the result cache and
+the knowledge base index, and implements single, combined, separate and
+oversized-input (map-reduce) generation. It reports user-facing messages and
+progress through callbacks so the same code drives both app.py and the headless
+batch runner. The output parsing helpers used to split thinking from the
+Line 242/244/246 narrative live here as well.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import ollama
+
+from chunking import (
+    CHARS_PER_TOKEN,
+    EVIDENCE_INPUT_BUDGET,
+    NARRATIVE_INPUT_BUDGET,
+    estimate_tokens,
+    split_into_chunks,
+    strip_thinking,
+)
+from prompting import (
+    EVIDENCE_OPTIONS,
+    GENERATION_OPTIONS,
+    KEEP_ALIVE,
+    MODEL_NAME,
+    RETRIEVAL_MAX_CHARS,
+    RETRIEVAL_TOP_K,
+    build_evidence_messages,
+    build_narrative_messages,
+    format_evidence_notes,
+    prompt_eval_stats,
+)
+from result_cache import ResultCache, modelfile_digest, result_cache_key
+from retrieval import KnowledgeIndex
+
+logger = logging.getLogger(__name__)
+
+# Default number of requests sent to Ollama in parallel
+OLLAMA_CONCURRENCY = int(os.environ.get("SRED_OLLAMA_CONCURRENCY", "2"))
+
+# Evidence-extraction rounds allowed before an oversized input is truncated
+MAX_CONDENSE_ROUNDS = 3
+
+
+class NarrativeGenerationError(RuntimeError):
+    """Raised when Ollama cannot produce a narrative."""
+
+
+def format_narrative_output(raw_output: str) -> tuple[str, str, str]:
+    """
+    Splits the raw narrative into thinking process and formatted output.
+    Returns: (thinking_process, formatted_narrative, full_output_for_download)
+    """
+    # Split by the first occurrence of "## Line 242" to separate thinking from output
+    lines = raw_output.split("\n")
+    thinking_lines = []
+    narrative_lines = []
+    in_narrative = False
+
+    for line in lines:
+        if "## Line 242" in line:
+            in_narrative = True
+
+        if in_narrative:
+            narrative_lines.append(line)
+        else:
+            thinking_lines.append(line)
+
+    thinking_text = "\n".join(thinking_lines).strip()
+    narrative_text = "\n".join(narrative_lines).strip()
+
+    # Enhance formatting: add bullets and structure
+    formatted_narrative = enhance_narrative_formatting(narrative_text)
+
+    return thinking_text, formatted_narrative, format_download(thinking_text, formatted_narrative)
+
+
+def format_download(thinking_text: str, formatted_narrative: str) -> str:
+    """Full output for download: both the thinking process and the narrative."""
+    return f"=== AI THINKING PROCESS ===\n\n{thinking_text}\n\n=== TECHNICAL NARRATIVE FOR T661 FORM ===\n\n{formatted_narrative}"
+
+
+def enhance_narrative_formatting(narrative: str) -> str:
+    """
+    Enhances narrative formatting with bullets, bold text, and clearer section separation.
+    """
+    formatted = narrative.replace("**", "**")  # Preserve bold
+    # Add more visual separation
+    formatted = formatted.replace("## Line 242", "\n---\n## 📋 Line 242: Technological Uncertainty\n---")
+    formatted = formatted.replace("## Line 244", "\n---\n## 📋 Line 244: Systematic Investigation\n---")
+    formatted = formatted.replace("## Line 246", "\n---\n## 📋 Line 246: Technological Advancement\n---")
+
+    return formatted
+
+
+class NarrativeStreamParser:
+    """
+    Incrementally splits streamed model output into thinking and narrative.
+    Follows the same rule as format_narrative_output (everything before the first
+    "## Line 242" line is thinking) but works line by line as chunks arrive, so the
+    UI can render partial results without re-parsing the full text. Each narrative
+    line is formatted once, when it completes.
+    """
+    SECTION_MARKERS = ("## Line 242", "## Line 244", "## Line 246")
+
+    def __init__(self):
+        self._pending = ""
+        self.thinking_lines = []
+        self.narrative_lines = []
+        self.current_section = None
+
+    def feed(self, chunk: str) -> None:
+        """Adds a streamed chunk; only complete lines are classified."""
+        self._pending += chunk
+        *complete_lines, self._pending = self._pending.split("\n")
+        for line in complete_lines:
+            self._add_line(line)
+
+    def _add_line(self, line: str) -> None:
+        for marker in self.SECTION_MARKERS:
+            if marker in line and (self.current_section is not None or marker == "## Line 242"):
+                self.current_section = marker
+
+        if self.current_section is None:
+            self.thinking_lines.append(line)
+        else:
+            # format_narrative_output strips the narrative before formatting; the first
+            # line is where leading whitespace (and the added separator's newline) must survive
+            if not self.narrative_lines:
+                line = line.lstrip()
+            self.narrative_lines.append(enhance_narrative_formatting(line))
+
+    def snapshot(self) -> tuple[str, str]:
+        """Returns (thinking, formatted_narrative) including the unfinished last line."""
+        if self.current_section is None:
+            return "\n".join(self.thinking_lines + [self._pending]).strip(), ""
+        narrative = "\n".join(self.narrative_lines + [enhance_narrative_formatting(self._pending)]).rstrip()
+        return "\n".join(self.thinking_lines).strip(), narrative
+
+    def finish(self) -> tuple[str, str, str]:
+        """
+        Flushes the trailing partial line.
+        Returns: (thinking_process, formatted_narrative, full_output_for_download),
+        identical to format_narrative_output on the whole response.
+        """
+        if self._pending:
+            self._add_line(self._pending)
+            self._pending = ""
+        thinking_text = "\n".join(self.thinking_lines).strip()
+        formatted_narrative = "\n".join(self.narrative_lines).rstrip()
+        return thinking_text, formatted_narrative, format_download(thinking_text, formatted_narrative)
+
+
+def report_timing(on_timing, stage: str, started: float) -> None:
+    """Passes the seconds since `started` to an on_timing(stage, seconds) callback, if any."""
+    if on_timing is not None:
+        on_timing(stage, time.perf_counter() - started)
+
+
+def request_stats(response, stage: str, started: float, first_token_at: float | None = None) -> dict:
+    """prompt_eval_stats plus the request's stage label and client-side wall times."""
+    stats = prompt_eval_stats(response)
+    stats['stage'] = stage
+    stats['wall_seconds'] = time.perf_counter() - started
+    if first_token_at is not None:
+        stats['first_token_seconds'] = first_token_at - started
+    return stats
+
+
+def parallel_requests(source_texts: list[str], mode: str, concurrency: int) -> int:
+    """
+    Most Ollama requests process_multiple_inputs will have in flight at once for
+    these inputs: 1 for a combined input that fits the narrative budget, up to one
+    per input in separate mode, and `concurrency` whenever evidence extraction runs.
+    """
+    concurrency = max(1, concurrency)
+    texts = ["\n\n---\n\n".join(source_texts)] if mode == "combined" else source_texts
+    if any(estimate_tokens(text) > NARRATIVE_INPUT_BUDGET for text in texts):
+        return concurrency
+    return min(concurrency, len(texts))
+
+
+def log_notify(level: str, message: str) -> None:
+    """Default notifier: routes user-facing messages to the module logger."""
+    logger.log(logging.WARNING if level in ("warning", "error") else logging.INFO, message)
+
+
+class NarrativeGenerator:
+    """
+    Generates SR&ED narratives through Ollama.
+
+    notify(level, message) receives user-facing messages, with level one of
+    "info", "caption", "warning" or "error". on_progress(stage, done, total) is
+    called with done=0 when a multi-request stage ("evidence" or "narratives")
+    starts and again as each request finishes. Both run on the calling thread.
+    """
+
+    def __init__(self, result_cache: ResultCache | None = None, knowledge_index: KnowledgeIndex | None = None,
+                 host: str | None = None, notify=log_notify, on_progress=None):
+        self.result_cache = result_cache
+        self.knowledge_index = knowledge_index
+        self.host = host
+        self.client = ollama.Client(host=host)
+        self.notify = notify
+        self.on_progress = on_progress
+        # Digest of the Modelfile the 'sred-expert' model is built from; part of the result cache key
+        self.modelfile_digest = modelfile_digest()
+
+    def warm_up(self) -> None:
+        """
+        Loads the model into Ollama without generating anything, using the same
+        num_ctx as real requests so the loaded runner is reused rather than reloaded.
+        """
+        self.client.chat(
+            model=MODEL_NAME,
+            messages=[],
+            options={'num_ctx': GENERATION_OPTIONS['num_ctx']},
+            keep_alive=KEEP_ALIVE
+        )
+
+    def _progress(self, stage: str, done: int, total: int) -> None:
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
+
+    def narrative_messages(self, extracted_text: str) -> list[dict]:
+        """
+        Builds the narrative prompt, including only the top-k knowledge base passages
+        relevant to this input when retrieval is enabled (SRED_RETRIEVAL_TOP_K > 0).
+        """
+        if RETRIEVAL_TOP_K <= 0 or self.knowledge_index is None:
+            return build_narrative_messages(extracted_text)
+        passages = self.knowledge_index.reference_passages(extracted_text, RETRIEVAL_TOP_K, RETRIEVAL_MAX_CHARS)
+        return build_narrative_messages(extracted_text, passages)
+
+    def lookup_cached(self, messages: list[dict], use_cache: bool, options: dict = GENERATION_OPTIONS) -> tuple[str, str | None]:
+        """
+        Returns (cache_key, cached_response_or_None) for a generation request.
+        When use_cache is False the lookup is skipped and counted as a bypass.
+        """
+        cache_key = result_cache_key(MODEL_NAME, options, self.modelfile_digest, messages)
+        if self.result_cache is None:
+            return cache_key, None
+        if not use_cache:
+            self.result_cache.record_bypass()
+            return cache_key, None
+        return cache_key, self.result_cache.get(cache_key)
+
+    def _store(self, cache_key: str, content: str) -> None:
+        if content and self.result_cache is not None:
+            self.result_cache.put(cache_key, content)
+
+    def generate(self, extracted_text: str, on_chunk=None, on_stats=None, use_cache: bool = True, on_timing=None) -> str:
+        """
+        Generates the SR&ED narrative for text that fits the context window.
+        When on_chunk is given, the response is streamed and each token chunk is passed
+        to it as it arrives; the full text is still returned at the end.
+        on_stats receives the request's prefill/decode token counts and durations.
+        on_timing(stage, seconds) receives the "prompt_assembly" and "generation" times.
+        With use_cache, an identical earlier request is answered from the result cache.
+        Raises NarrativeGenerationError if Ollama fails.
+        """
+        started = time.perf_counter()
+        messages = self.narrative_messages(extracted_text)
+        report_timing(on_timing, "prompt_assembly", started)
+
+        started = time.perf_counter()
+        try:
+            cache_key, cached = self.lookup_cached(messages, use_cache)
+            if cached is not None:
+                self.notify("caption", "♻️ Served from the result cache (tick \"Regenerate anyway\" to bypass)")
+                if on_chunk is not None:
+                    on_chunk(cached)
+                return cached
+
+            if on_chunk is None:
+                response = self.client.chat(
+                    model=MODEL_NAME,
+                    messages=messages,
+                    options=GENERATION_OPTIONS,
+                    keep_alive=KEEP_ALIVE
+                )
+                if on_stats is not None:
+                    on_stats(request_stats(response, "narrative", started))
+                content = response['message']['content']
+                self._store(cache_key, content)
+                return content
+
+            # Streaming mode: forward each token chunk as soon as Ollama emits it
+            pieces = []
+            first_token_at = None
+            for chunk in self.client.chat(
+                model=MODEL_NAME,
+                messages=messages,
+                options=GENERATION_OPTIONS,
+                keep_alive=KEEP_ALIVE,
+                stream=True
+            ):
+                piece = chunk['message']['content']
+                if piece:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    pieces.append(piece)
+                    on_chunk(piece)
+                # The final chunk carries the token accounting
+                if chunk.get('done') and on_stats is not None:
+                    on_stats(request_stats(chunk, "narrative", started, first_token_at))
+            content = "".join(pieces)
+            self._store(cache_key, content)
+            return content
+        except Exception as e:
+            raise NarrativeGenerationError(
+                f"Error communicating with Ollama. Is the '{MODEL_NAME}' model running? Details: {e}"
+            ) from e
+        finally:
+            report_timing(on_timing, "generation", started)
+
+    async def chat_concurrently(self, message_lists: list[list[dict]], concurrency: int, options: dict = GENERATION_OPTIONS,
+                                on_done=None, on_stats=None, use_cache: bool = True, stage: str = "narrative") -> list:
+        """
+        Sends one chat request per message list through the Ollama async client, with at
+        most `concurrency` requests in flight (pair with OLLAMA_NUM_PARALLEL on the server).
+        Returns response texts in input order; a failed request yields its exception instead
+        of aborting the others. on_done(index, result) fires as each request finishes.
+        Cached results are returned without an Ollama request. Stats passed to on_stats
+        are labelled with `stage`.
+        """
+        client = ollama.AsyncClient(host=self.host)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run_one(index: int, messages: list[dict]):
+            try:
+                cache_key, result = self.lookup_cached(messages, use_cache, options)
+                if result is None:
+                    async with semaphore:
+                        started = time.perf_counter()
+                        response = await client.chat(
+                            model=MODEL_NAME,
+                            messages=messages,
+                            options=options,
+                            keep_alive=KEEP_ALIVE
+                        )
+                    result = response['message']['content']
+                    if on_stats is not None:
+                        on_stats(request_stats(response, stage, started))
+                    self._store(cache_key, result)
+            except Exception as e:
+                result = e
+            if on_done is not None:
+                on_done(index, result)
+            return result
+
+        return await asyncio.gather(*(run_one(i, messages) for i, messages in enumerate(message_lists)))
+
+    def condense_to_budget(self, text: str, concurrency: int, on_stats=None, use_cache: bool = True, on_timing=None) -> str:
+        """
+        Map step for inputs too large for one narrative prompt. The text is split on
+        commit/ticket boundaries into chunks that fit the context window, SR&ED evidence
+        is extracted from every chunk in parallel, and the joined notes replace the input.
+        Rounds repeat (up to MAX_CONDENSE_ROUNDS) until the notes fit, so the final
+        narrative (reduce) prompt stays bounded no matter how large the input is.
+        Text that already fits is returned unchanged. Time spent is reported to
+        on_timing as the "evidence" stage.
+        """
+        rounds = 0
+        while estimate_tokens(text) > NARRATIVE_INPUT_BUDGET and rounds < MAX_CONDENSE_ROUNDS:
+            rounds += 1
+            started = time.perf_counter()
+            chunks = split_into_chunks(text, EVIDENCE_INPUT_BUDGET)
+            self.notify(
+                "info",
+                f"📚 Input is ~{estimate_tokens(text):,} tokens, more than the model's ~{NARRATIVE_INPUT_BUDGET:,}-token budget. "
+                f"Extracting SR&ED evidence from {len(chunks)} chunks first..."
+            )
+            self._progress("evidence", 0, len(chunks))
+            finished = 0
+
+            def on_done(index: int, result) -> None:
+                nonlocal finished
+                finished += 1
+                self._progress("evidence", finished, len(chunks))
+
+            message_lists = [build_evidence_messages(chunk) for chunk in chunks]
+            results = asyncio.run(self.chat_concurrently(
+                message_lists, concurrency, options=EVIDENCE_OPTIONS, on_done=on_done, on_stats=on_stats, use_cache=use_cache,
+                stage="evidence"
+            ))
+            report_timing(on_timing, "evidence", started)
+
+            notes = []
+            for i, result in enumerate(results, 1):
+                if isinstance(result, Exception):
+                    self.notify("warning", f"⚠️ Evidence extraction failed for chunk {i}: {result}")
+                elif strip_thinking(result):
+                    notes.append(strip_thinking(result))
+            if not notes:
+                self.notify("error", "Evidence extraction failed for every chunk; the input will be truncated instead.")
+                break
+            text = format_evidence_notes(notes)
+
+        if estimate_tokens(text) > NARRATIVE_INPUT_BUDGET:
+            self.notify("warning", "⚠️ Input still exceeds the context budget and was truncated.")
+            text = text[:int(NARRATIVE_INPUT_BUDGET * CHARS_PER_TOKEN)]
+        return text
+
+    def process_separate_concurrently(self, source_texts: list[str], concurrency: int, on_chunk=None, on_stats=None,
+                                      use_cache: bool = True, on_timing=None) -> str:
+        """
+        Separate-mode generation with concurrent requests. Output is assembled in input
+        order as "### Narrative i" blocks; when streaming, each block is emitted as soon as
+        it and every block before it have finished.
+        """
+        results = [None] * len(source_texts)
+        finished = [False] * len(source_texts)
+        next_to_emit = 0
+        self._progress("narratives", 0, len(source_texts))
+
+        def block(index: int) -> str:
+            result = results[index]
+            if isinstance(result, Exception):
+                result = f"_⚠️ Generation failed for this input: {result}_"
+            return f"### Narrative {index + 1}\n\n{result}"
+
+        def on_done(index: int, result) -> None:
+            nonlocal next_to_emit
+            results[index] = result
+            finished[index] = True
+            self._progress("narratives", sum(finished), len(source_texts))
+            if isinstance(result, Exception):
+                self.notify("error", f"Error generating narrative {index + 1}: {result}")
+            while on_chunk is not None and next_to_emit < len(source_texts) and finished[next_to_emit]:
+                on_chunk(("\n\n---\n\n" if next_to_emit > 0 else "") + block(next_to_emit))
+                next_to_emit += 1
+
+        started = time.perf_counter()
+        message_lists = [self.narrative_messages(text) for text in source_texts]
+        report_timing(on_timing, "prompt_assembly", started)
+        started = time.perf_counter()
+        asyncio.run(self.chat_concurrently(message_lists, concurrency, on_done=on_done, on_stats=on_stats, use_cache=use_cache))
+        report_timing(on_timing, "generation", started)
+        if all(isinstance(result, Exception) for result in results):
+            raise NarrativeGenerationError(f"All {len(source_texts)} narratives failed: {results[0]}")
+        return "\n\n---\n\n".join(block(i) for i in range(len(source_texts)))
+
+    def process_multiple_inputs(self, source_texts: list[str], mode: str, on_chunk=None, concurrency: int = 1,
+                                on_stats=None, use_cache: bool = True, on_timing=None) -> str:
+        """
+        Process one or more input texts based on user preference.
+        mode: "combined" or "separate"
+        on_chunk: optional streaming callback; receives the same text that is returned.
+        concurrency: requests in flight for separate-mode narratives and evidence extraction.
+        on_stats: optional callback receiving token accounting for each Ollama request.
+        use_cache: False bypasses the result cache and always regenerates.
+        on_timing: optional callback receiving (stage, seconds) for the "evidence",
+        "prompt_assembly" and "generation" stages; repeated stages should be summed.
+        Raises NarrativeGenerationError if no narrative could be produced.
+        """
+        if mode == "combined":
+            # Merge all texts into one context, condensing it first if it overflows the context window
+            combined_text = "\n\n---\n\n".join(source_texts)
+            combined_text = self.condense_to_budget(combined_text, concurrency, on_stats=on_stats, use_cache=use_cache, on_timing=on_timing)
+            return self.generate(combined_text, on_chunk=on_chunk, on_stats=on_stats, use_cache=use_cache, on_timing=on_timing)
+
+        source_texts = [
+            self.condense_to_budget(text, concurrency, on_stats=on_stats, use_cache=use_cache, on_timing=on_timing)
+            for text in source_texts
+        ]
+        if concurrency > 1:
+            return self.process_separate_concurrently(
+                source_texts, concurrency, on_chunk=on_chunk, on_stats=on_stats, use_cache=use_cache, on_timing=on_timing
+            )
+
+        # Generate separate narratives one by one (streaming tokens) and combine them
+        narratives = []
+        failures = 0
+        self._progress("narratives", 0, len(source_texts))
+        for i, text in enumerate(source_texts, 1):
+            header = f"### Narrative {i}\n\n"
+            if on_chunk is not None:
+                on_chunk(("\n\n---\n\n" if i > 1 else "") + header)
+            try:
+                narrative = self.generate(text, on_chunk=on_chunk, on_stats=on_stats, use_cache=use_cache, on_timing=on_timing)
+            except NarrativeGenerationError as e:
+                failures += 1
+                self.notify("error", f"Error generating narrative {i}: {e}")
+                narrative = f"_⚠️ Generation failed for this input: {e}_"
+                if on_chunk is not None:
+                    on_chunk(narrative)
+            narratives.append(f"{header}{narrative}")
+            self._progress("narratives", i, len(source_texts))
+        if failures == len(source_texts):
+            raise NarrativeGenerationError(f"All {len(source_texts)} narratives failed.")
+        return "\n\n---\n\n".join(narratives)
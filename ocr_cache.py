@@ -0,0 +1,74 @@
+"""
+Persistent, content-addressed cache for OCR results.
+
+Entries are keyed by a SHA-256 of the raw image bytes plus the OCR settings
+(languages, EasyOCR version, readtext parameters), so re-submitting the same
+screenshot skips image decoding and EasyOCR entirely. Each entry is a small
+text file; the directory is kept under a byte budget with least-recently-used
+eviction based on file modification times (refreshed on every hit).
+"""
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+OCR_CACHE_DIR = Path(os.environ.get("SRED_OCR_CACHE_DIR", Path(__file__).parent / ".cache" / "ocr"))
+OCR_CACHE_MAX_BYTES = int(os.environ.get("SRED_OCR_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+
+def ocr_cache_key(image_bytes: bytes, settings: dict) -> str:
+    """Returns the cache key for an image under the given OCR settings."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """Size-bounded on-disk LRU cache mapping cache keys to extracted text."""
+
+    def __init__(self, cache_dir: Path = OCR_CACHE_DIR, max_bytes: int = OCR_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.txt"
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached text, or None on a miss. A hit marks the entry as recently used."""
+        path = self._path(key)
+        try:
+            text = path.read_text(encoding="utf-8")
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        """Stores text for key, then evicts least-recently-used entries over the byte budget."""
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        for path in self.cache_dir.glob("*.txt"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+        # Oldest access first
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
@@ -0,0 +1,264 @@
+"""
+Concurrent OCR execution for multi-image uploads.
+
+Images are decoded and passed to EasyOCR on a thread pool that shares a single
+reader (PyTorch releases the GIL during inference, so threads scale without
+duplicating model weights per worker). At most `workers` images are decoded at
+any time, which bounds peak memory regardless of how many files are uploaded.
+Cache lookups happen up front on the calling thread; only misses reach the pool.
+Progress callbacks also run on the calling thread, so they may safely update
+Streamlit elements.
+
+Images are decoded straight from the upload buffer into a single grayscale (or
+BGR) array, downscaled when wider than EasyOCR needs, and very tall images are
+OCRed as overlapping horizontal tiles (views into that array) whose text is
+stitched back together in reading order, so neither a full-resolution colour
+copy nor a whole-page detector pass is ever needed.
+
+EasyOCR, PyTorch, OpenCV and NumPy are imported only when an image is actually
+decoded or the reader is built, so importing this module is cheap and text-only
+sessions never pay for them.
+"""
+import io
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from importlib import metadata
+from typing import TYPE_CHECKING
+
+from ocr_cache import OCRCache, ocr_cache_key
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Default number of images OCRed concurrently
+OCR_WORKERS = int(os.environ.get("SRED_OCR_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Languages passed to EasyOCR; part of the OCR cache key
+OCR_LANGUAGES = ['en']
+
+# Decode to grayscale (EasyOCR's recogniser works on grayscale anyway); SRED_OCR_GRAYSCALE=0 keeps colour
+OCR_GRAYSCALE = os.environ.get("SRED_OCR_GRAYSCALE", "1") != "0"
+# Wider images are downscaled to this width before OCR; 0 disables downscaling
+OCR_MAX_WIDTH = int(os.environ.get("SRED_OCR_MAX_WIDTH", "2000"))
+# Taller images are OCRed in tiles of this height overlapping by OCR_TILE_OVERLAP; 0 disables tiling
+OCR_TILE_HEIGHT = int(os.environ.get("SRED_OCR_TILE_HEIGHT", "2000"))
+# Must exceed the tallest text line so a line cut by one tile boundary is whole in the neighbouring tile
+OCR_TILE_OVERLAP = 160
+
+
+@dataclass
+class OCRJob:
+    name: str
+    image_bytes: bytes
+
+
+@dataclass
+class OCRResult:
+    name: str
+    text: str = ""
+    cache_hit: bool = False
+    error: str | None = None
+    seconds: float = 0.0
+
+
+_reader = None
+_reader_lock = threading.Lock()
+
+
+def create_reader(languages: list[str] = OCR_LANGUAGES):
+    """Constructs an EasyOCR reader (loads PyTorch and the detection/recognition models)."""
+    import easyocr
+
+    print("Loading EasyOCR reader...")
+    reader = easyocr.Reader(languages)
+    print("Reader loaded.")
+    return reader
+
+
+def get_reader():
+    """
+    Returns the process-wide EasyOCR reader, building it on first use.
+    Safe to call from a warm-up thread and a request at the same time: the
+    second caller waits for the first load instead of loading the models twice.
+    """
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            _reader = create_reader()
+        return _reader
+
+
+def reader_loaded() -> bool:
+    return _reader is not None
+
+
+def ocr_settings(languages: list[str] = OCR_LANGUAGES) -> dict:
+    """Everything that affects OCR output for a given image, used to key the OCR cache."""
+    return {
+        'languages': languages,
+        # Read from package metadata so building a cache key doesn't import PyTorch
+        'easyocr_version': metadata.version('easyocr'),
+        'readtext': {},
+        'decode': {
+            'grayscale': OCR_GRAYSCALE,
+            'max_width': OCR_MAX_WIDTH,
+            'tile_height': OCR_TILE_HEIGHT,
+            'tile_overlap': OCR_TILE_OVERLAP,
+        },
+    }
+
+
+def image_size(image_bytes: bytes) -> tuple[int, int]:
+    """(width, height) from the image header, without decoding pixels."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.size
+
+
+def decode_image(image_bytes: bytes, grayscale: bool = OCR_GRAYSCALE, max_width: int = OCR_MAX_WIDTH) -> "np.ndarray":
+    """
+    Decodes an uploaded image straight from its buffer into the array EasyOCR reads:
+    single-channel grayscale, or BGR when grayscale is off. Images wider than
+    max_width are decoded at 1/2, 1/4 or 1/8 scale where possible (inside the JPEG
+    decoder, for JPEGs) and then area-resized down to max_width.
+    """
+    import cv2
+    import numpy as np
+
+    # Wraps the upload bytes without copying them
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    reduction = 1
+    if max_width > 0:
+        width, _ = image_size(image_bytes)
+        while reduction < 8 and width // (reduction * 2) >= max_width:
+            reduction *= 2
+    flags = {
+        1: (cv2.IMREAD_GRAYSCALE, cv2.IMREAD_COLOR),
+        2: (cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_COLOR_2),
+        4: (cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_COLOR_4),
+        8: (cv2.IMREAD_REDUCED_GRAYSCALE_8, cv2.IMREAD_REDUCED_COLOR_8),
+    }
+    image = cv2.imdecode(buffer, flags[reduction][0 if grayscale else 1])
+    if image is None:
+        raise ValueError("Could not decode image")
+    if max_width > 0 and image.shape[1] > max_width:
+        height = max(1, round(image.shape[0] * max_width / image.shape[1]))
+        image = cv2.resize(image, (max_width, height), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def tile_bounds(height: int, tile_height: int = OCR_TILE_HEIGHT, overlap: int = OCR_TILE_OVERLAP) -> list[tuple[int, int]]:
+    """(top, bottom) rows of overlapping tiles covering an image; one tile if it is short enough."""
+    if tile_height <= 0 or height <= tile_height:
+        return [(0, height)]
+    step = max(1, tile_height - overlap)
+    bounds = []
+    top = 0
+    while True:
+        bottom = min(top + tile_height, height)
+        bounds.append((top, bottom))
+        if bottom >= height:
+            return bounds
+        top += step
+
+
+def ocr_image(reader, image: "np.ndarray", tile_height: int = OCR_TILE_HEIGHT, overlap: int = OCR_TILE_OVERLAP) -> str:
+    """
+    OCRs a decoded image tile by tile and returns its text in reading order.
+    Each overlap is split at its midpoint and a detection is kept only by the tile
+    that owns its vertical centre, so lines in the overlap are not duplicated.
+    """
+    bounds = tile_bounds(image.shape[0], tile_height, overlap)
+    lines = []
+    for index, (top, bottom) in enumerate(bounds):
+        keep_from = overlap / 2 if index > 0 else 0
+        keep_to = (bottom - top) - overlap / 2 if index < len(bounds) - 1 else bottom - top
+        # Row slices of a C-contiguous array are contiguous views, not copies
+        for box, text, _ in reader.readtext(image[top:bottom]):
+            ys = [point[1] for point in box]
+            if keep_from <= (min(ys) + max(ys)) / 2 < keep_to:
+                lines.append(text)
+    return "\n".join(lines)
+
+
+def configure_torch_threads(workers: int) -> None:
+    """Splits CPU cores between OCR workers so concurrent readtext calls don't oversubscribe."""
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, workers)))
+
+
+def _ocr_one(reader, job: OCRJob) -> OCRResult:
+    started = time.perf_counter()
+    try:
+        text = ocr_image(reader, decode_image(job.image_bytes))
+        return OCRResult(job.name, text=text, seconds=time.perf_counter() - started)
+    except Exception as e:
+        return OCRResult(job.name, error=str(e), seconds=time.perf_counter() - started)
+
+
+def run_ocr_jobs(jobs: list[OCRJob], load_reader, settings: dict, cache: OCRCache | None = None,
+                 workers: int = OCR_WORKERS, on_progress=None) -> list[OCRResult]:
+    """
+    OCRs every job and returns results in input order.
+    load_reader() (e.g. get_reader) is only called when some image misses the cache,
+    so fully cached submissions never import PyTorch or build the EasyOCR reader.
+    on_progress(done, total, result) is called once per image as it finishes.
+    Failed images are reported via OCRResult.error instead of raising.
+    """
+    total = len(jobs)
+    results: list[OCRResult | None] = [None] * total
+    done = 0
+    pending_jobs = []
+
+    for index, job in enumerate(jobs):
+        key = ocr_cache_key(job.image_bytes, settings)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            results[index] = OCRResult(job.name, text=cached, cache_hit=True)
+            done += 1
+            if on_progress is not None:
+                on_progress(done, total, results[index])
+        else:
+            pending_jobs.append((index, key, job))
+
+    if not pending_jobs:
+        return results
+
+    reader = load_reader()
+    workers = max(1, min(workers, len(pending_jobs)))
+    configure_torch_threads(workers)
+    queue = iter(pending_jobs)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr") as executor:
+        in_flight = {}
+
+        def submit_next() -> None:
+            item = next(queue, None)
+            if item is not None:
+                index, key, job = item
+                in_flight[executor.submit(_ocr_one, reader, job)] = (index, key)
+
+        # Only `workers` images are submitted (and therefore decoded) at once
+        for _ in range(workers):
+            submit_next()
+
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, key = in_flight.pop(future)
+                result = future.result()
+                if result.error is None and cache is not None:
+                    cache.put(key, result.text)
+                results[index] = result
+                done += 1
+                if on_progress is not None:
+                    on_progress(done, total, result)
+                submit_next()
+
+    return results
@@ -0,0 +1,267 @@
+"""
+Prompt assembly for SR&ED narrative generation.
+
+Ollama reuses the KV cache for the longest prompt prefix shared with the
+previous request on the same model slot, so every static part of the prompt
+(system prompt, task instructions and, when retrieval is off, the knowledge
+base and few-shot examples) is built once at import time into a byte-identical
+prefix, and the variable parts (retrieved passages, extracted text) are
+appended last. Only the new tokens then need prefill.
+"""
+import os
+
+MODEL_NAME = 'sred-expert'
+
+# Context window requested from Ollama; prompts are chunked to fit inside it
+NUM_CTX = int(os.environ.get("SRED_NUM_CTX", "8192"))
+GENERATION_OPTIONS = {'temperature': 0.5, 'num_ctx': NUM_CTX}
+
+# Tokens left free for the model's thinking and narrative when sizing inputs
+RESPONSE_TOKEN_RESERVE = int(os.environ.get("SRED_RESPONSE_TOKEN_RESERVE", "2048"))
+
+# Evidence extraction (map) calls are capped so chunk notes stay short
+EVIDENCE_MAX_TOKENS = int(os.environ.get("SRED_EVIDENCE_MAX_TOKENS", "1536"))
+EVIDENCE_OPTIONS = {'temperature': 0.2, 'num_ctx': NUM_CTX, 'num_predict': EVIDENCE_MAX_TOKENS}
+
+# How long Ollama keeps the model (and its KV cache) loaded after a request
+KEEP_ALIVE = os.environ.get("SRED_OLLAMA_KEEP_ALIVE", "30m")
+
+# Knowledge Base-Informed Prompting (Enhanced from user-provided corpus)
+KNOWLEDGE_BASE_CONTEXT = """
+=== SR&ED KNOWLEDGE BASE CONTEXT ===
+
+CORE SR&ED CONCEPTS (The 5 Questions):
+1. Was there a scientific or technological uncertainty? (Not business uncertainty - must be technical)
+2. Did it involve formulating hypotheses? (Specific, testable technical statements, not business goals)
+3. Was the approach systematic? (Testing, analysis, experiments, not routine work)
+4. Was the goal technological advancement? (Advancing the field, not just the product)
+5. Were records/documentation kept? (Contemporaneous evidence is critical)
+
+KEY DISTINCTIONS TO GET RIGHT:
+- Business Goal ("We will make the software faster") ≠ SR&ED Hypothesis ("Algorithm X will reduce latency by overcoming the bottleneck")
+- Business Project (overall commercial goal) ≠ SR&ED Project (focused sub-project addressing specific technical uncertainty)
+- Routine engineering (standard practice, ineligible) ≠ Experimental development (novel approach, eligible)
+- Product advancement (user-facing improvements) ≠ Technological advancement (new knowledge, underlying tech)
+- Failed project (ineligible if no real experimentation) ≠ Failed experiment (eligible - proves a hypothesis wrong)
+
+PROCESS MODEL - The Narrative Must Show:
+PHASE 1 (Pre-Claim): Identify the Technological Uncertainty → Formulate SR&ED Hypothesis → Establish Documentation
+PHASE 2 (Preparation): Gather Evidence → Separate SR&ED work from routine work → Write narratives for Lines 242, 244, 246
+PHASE 3 (Filing/Review): Submit T661 form → Defend with Contemporaneous Documentation
+
+THE THREE NARRATIVE SECTIONS (T661 Form Lines 242, 244, 246):
+
+LINE 242 - TECHNOLOGICAL UNCERTAINTY:
+- What specific technical problem could NOT be resolved using standard practice or publicly known solutions?
+- Why was this problem non-obvious or novel? (Prove it wasn't routine)
+- What was the "whether" or "how" that wasn't known?
+- AVOID: Vague claims. BE SPECIFIC about what made this technically uncertain.
+
+LINE 244 - SYSTEMATIC INVESTIGATION (The Proof of Process):
+- What hypothesis did you formulate to test? (Specific, testable statement)
+- What experiments, tests, or analyses did you conduct?
+- What data did you collect? What tools, methods did you use?
+- Show a logical progression: Hypothesis → Test → Result → Conclusion
+- Include failed attempts - these are evidence of systematic investigation
+- AVOID: High-level summaries. BE CONCRETE about the investigation process.
+
+LINE 246 - TECHNOLOGICAL ADVANCEMENT (The Knowledge Gained):
+- What new knowledge or capability did you gain? (Not commercial success - knowledge itself)
+- How does this advance the underlying technology or field?
+- What was learned that changes how you or others would solve similar problems?
+- This can be negative learning too ("Approach X doesn't work" is advancement)
+- AVOID: Confusing product benefits with technological advancement.
+
+ENTITY MODEL - Key Relationships:
+Project is DEFINED BY Technological Uncertainty
+Project is TESTED VIA SR&ED Hypothesis
+Project is PROVEN BY Contemporaneous_Documentation (commits, tickets, lab notes, timesheets)
+Contemporaneous Documentation = Jira tickets, code commits, dated timesheets, meeting minutes, email threads, photos
+CRITICAL: Use existing tools (Jira, GitHub, Trello) with SR&ED tags as your evidence source
+
+COMMON PITFALLS TO AVOID:
+- Claiming "routine debugging" as SR&ED work
+- Vague language without specific technical details
+- Confusing business goals with technological uncertainty
+- Failing to show WHY existing solutions wouldn't work
+- Using future tense instead of describing actual completed work
+- Not separating SR&ED work from routine work
+"""
+
+SYSTEM_PROMPT_CORE = """You are an expert Canadian SR&ED consultant. Your role is to analyze technical work and generate compelling, CRA-compliant narratives for the T661 form.
+
+CRITICAL PRINCIPLES:
+1. SPECIFICITY: Always use concrete technical details (algorithm names, data structures, performance metrics, specific challenges)
+2. LINKING: Clearly connect technological uncertainty → systematic investigation → advancement (the three-part story)
+3. DISTINCTION: Actively separate SR&ED work from routine work; explain WHY the work was experimental/novel
+4. EVIDENCE: Reference documented activities (commits, tickets, tests, experiments) as proof of systematic investigation
+5. HONESTY: Failed experiments and negative results are valid SR&ED - show the investigation process, not just success
+
+TONE: Professional, technical, suitable for a CRA assessor with some software development / engineering / scientific knowledge, but not domain expert level in your specific technology."""
+
+FEW_SHOT_EXAMPLES = """REFERENCE EXAMPLES (Few-Shot Training)
+
+These examples demonstrate the pattern and structure for SR&ED-qualifying work narratives:
+
+EXAMPLE 1: Agri-Tech Automation
+Uncertainty: Could a novel humidity control mechanism stabilize rapidly changing greenhouse environments?
+Work: Developed and trialed several control algorithms, modified hardware configurations, logged results under variable conditions, reviewed failure modes systematically.
+Advancement: Clarified the instability factors affecting greenhouse automation, contributing new knowledge to agri-tech climate control through sensor response time analysis and algorithm tuning parameters.
+
+EXAMPLE 2: Food Processing R&D
+Uncertainty: Would natural preservative alternatives maintain shelf life and safety under real-world pH variation?
+Work: Formulated experimental batches, varied pH conditions to simulate storage scenarios, tracked spoilage indicators, performed stability tests.
+Advancement: Negative results revealed critical failure factors—specifically, pH sensitivity was higher than expected. These conclusions informed future development and advanced understanding of natural preservative chemistry.
+
+EXAMPLE 3: Manufacturing Alloy Development
+Uncertainty: Could new alloy compositions increase tool durability beyond commercial standards under elevated temperatures?
+Work: Designed multiple prototype compositions with varying nickel percentages, manufactured test samples, tested at progressively escalating temperatures to identify failure points.
+Advancement: Discovered a technical limit to temperature resistance and documented the precise role of nickel percentage. This clarified the composition-durability relationship, advancing sector knowledge.
+
+EXAMPLE 4: Software Algorithm Optimization
+Uncertainty: Could novel algorithms optimize large dataset sorting without common performance bottlenecks?
+Work: Formulated efficiency hypothesis, coded and compared multiple algorithm variants, used 8M+ record benchmarking dataset, logged both successes and edge-case failures.
+Advancement: Identified the true bottleneck (memory access patterns vs. computational complexity) and published a new algorithm approach addressing this limitation."""
+
+# Full system prompt used when retrieval is disabled
+SYSTEM_PROMPT = f"{SYSTEM_PROMPT_CORE}\n\n---\n\n{FEW_SHOT_EXAMPLES}"
+
+TASK_INSTRUCTIONS = """---YOUR TASK---
+Analyze the technical data provided at the end of this message and generate a compelling technical narrative for a Canadian SR&ED claim.
+
+Structure your response with THREE clearly labeled sections (one for each form field):
+
+## Line 242: Technological Uncertainty
+Describe the specific technical problem or challenge that could NOT be resolved using standard practice or publicly known solutions. Explain WHY this was uncertain/non-obvious. Be specific about what made this work experimental.
+
+## Line 244: Systematic Investigation
+Detail the methodical approach used to test the hypothesis. Describe:
+- The specific hypothesis you were testing
+- Experiments or tests conducted
+- Data collected and analyzed
+- Tools and methods used
+- Logical progression from hypothesis → test → result
+- Include any failed attempts or negative results (these prove systematic investigation)
+
+## Line 246: Technological Advancement
+Explain the new knowledge or capability gained. Describe:
+- What did you learn that advances the underlying technology/field?
+- How does this change how the problem would be solved in the future?
+- What new understanding was gained (even if negative/failure results)?
+- Why is this advancement in TECHNOLOGY, not just in the product?
+
+QUALITY GUIDELINES:
+- Use specific technical terms, algorithm names, metrics (not generic language)
+- Show WHY existing solutions/APIs/frameworks wouldn't work
+- Explicitly separate SR&ED work from routine work
+- Use active voice describing completed work (not future tense)
+- Reference specific dates, tools, people when helpful
+- Keep narrative cohesive: the three sections should tell ONE continuous story"""
+
+EXTRACTED_DATA_HEADER = "---EXTRACTED TECHNICAL DATA TO ANALYZE---"
+REFERENCE_MATERIAL_HEADER = "---REFERENCE MATERIAL (SR&ED KNOWLEDGE BASE EXCERPTS AND EXAMPLES)---"
+
+# Everything before the extracted text; identical on every request
+STATIC_USER_PREFIX = f"{KNOWLEDGE_BASE_CONTEXT}\n\n{TASK_INSTRUCTIONS}\n\n{EXTRACTED_DATA_HEADER}\n"
+
+# With retrieval, only the instructions are static; retrieved passages and the data follow
+STATIC_RETRIEVAL_PREFIX = f"{TASK_INSTRUCTIONS}\n\n{REFERENCE_MATERIAL_HEADER}\n"
+
+# Passages retrieved per request from the research/ knowledge base; 0 sends the full fixed block instead
+RETRIEVAL_TOP_K = int(os.environ.get("SRED_RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_MAX_CHARS = int(os.environ.get("SRED_RETRIEVAL_MAX_CHARS", "4000"))
+
+# Upper bound on prompt characters outside the extracted text, used to size input chunks
+if RETRIEVAL_TOP_K > 0:
+    NARRATIVE_PROMPT_OVERHEAD_CHARS = (
+        len(SYSTEM_PROMPT_CORE) + len(STATIC_RETRIEVAL_PREFIX) + RETRIEVAL_MAX_CHARS + len(EXTRACTED_DATA_HEADER) + 4
+    )
+else:
+    NARRATIVE_PROMPT_OVERHEAD_CHARS = len(SYSTEM_PROMPT) + len(STATIC_USER_PREFIX)
+
+
+def build_narrative_messages(extracted_text: str, reference_passages: list[str] | None = None) -> list[dict]:
+    """
+    Builds the chat messages for one narrative request.
+    Without reference_passages, uses the full knowledge base and few-shot examples.
+    With them (from the retrieval index), only those passages are included, placed
+    after the static instructions so the cacheable prefix is unchanged.
+    """
+    if reference_passages is None:
+        return [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': STATIC_USER_PREFIX + extracted_text}
+        ]
+    references = "\n\n".join(reference_passages)
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT_CORE},
+        {'role': 'user', 'content': f"{STATIC_RETRIEVAL_PREFIX}{references}\n\n{EXTRACTED_DATA_HEADER}\n{extracted_text}"}
+    ]
+
+
+def prompt_eval_stats(response) -> dict:
+    """
+    Extracts prefill/decode token counts and durations from an Ollama chat response
+    (or the final streamed chunk). Durations are converted from nanoseconds to seconds.
+    """
+    def field(name):
+        value = response.get(name)
+        return value or 0
+
+    stats = {
+        'prompt_eval_count': field('prompt_eval_count'),
+        'prompt_eval_seconds': field('prompt_eval_duration') / 1e9,
+        'eval_count': field('eval_count'),
+        'eval_seconds': field('eval_duration') / 1e9,
+        'load_seconds': field('load_duration') / 1e9,
+        'total_seconds': field('total_duration') / 1e9,
+    }
+    stats['prompt_tokens_per_second'] = stats['prompt_eval_count'] / stats['prompt_eval_seconds'] if stats['prompt_eval_seconds'] else 0.0
+    stats['eval_tokens_per_second'] = stats['eval_count'] / stats['eval_seconds'] if stats['eval_seconds'] else 0.0
+    return stats
+
+
+def format_prompt_stats(stats: dict) -> str:
+    """One-line human-readable summary of prompt_eval_stats output."""
+    return (
+        f"Prefill: {stats['prompt_eval_count']} tokens in {stats['prompt_eval_seconds']:.2f}s"
+        f" · Output: {stats['eval_count']} tokens at {stats['eval_tokens_per_second']:.1f} tok/s"
+        f" · Load: {stats['load_seconds']:.2f}s"
+    )
+
+
+EVIDENCE_SYSTEM_PROMPT = """You are an expert Canadian SR&ED consultant reviewing one part of a long technical work log. You extract evidence for a later T661 narrative; you do not write the narrative yourself."""
+
+EVIDENCE_INSTRUCTIONS = """---YOUR TASK---
+Extract the SR&ED evidence from the work log excerpt provided at the end of this message. Output concise bullet points under these headings, omitting any heading with no evidence:
+
+UNCERTAINTIES: technical problems that standard practice could not resolve
+HYPOTHESES: specific, testable technical statements
+EXPERIMENTS: tests, prototypes and analyses performed, with dates, commits or ticket IDs
+RESULTS: measured outcomes, metrics and failures
+ADVANCEMENTS: new knowledge gained, including negative results
+
+Keep technical specifics (algorithm names, parameters, metrics, commit hashes, ticket IDs). Ignore routine work such as formatting, dependency bumps or typo fixes."""
+
+EVIDENCE_DATA_HEADER = "---WORK LOG EXCERPT---"
+
+# Static prefix for evidence extraction calls, mirroring STATIC_USER_PREFIX
+STATIC_EVIDENCE_PREFIX = f"{EVIDENCE_INSTRUCTIONS}\n\n{EVIDENCE_DATA_HEADER}\n"
+
+
+def build_evidence_messages(chunk_text: str) -> list[dict]:
+    """Builds the chat messages for extracting SR&ED evidence from one chunk of a long input."""
+    return [
+        {'role': 'system', 'content': EVIDENCE_SYSTEM_PROMPT},
+        {'role': 'user', 'content': STATIC_EVIDENCE_PREFIX + chunk_text}
+    ]
+
+
+def format_evidence_notes(notes: list[str]) -> str:
+    """Joins per-chunk evidence notes into the input for the final narrative (reduce) pass."""
+    parts = [f"[Part {i} of {len(notes)}]\n{note.strip()}" for i, note in enumerate(notes, 1)]
+    header = (
+        f"The following SR&ED evidence was extracted from {len(notes)} consecutive parts of a long work log. "
+        "Treat it as one project record."
+    )
+    return header + "\n\n" + "\n\n".join(parts)
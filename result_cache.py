@@ -0,0 +1,119 @@
+"""
+Persistent cache of generated narratives, stored in SQLite.
+
+A result is keyed on everything that determines the model's output: the model
+name, the generation options, a digest of the Modelfile the model was built
+from, and a hash of the full prompt messages. Entries expire after a TTL and
+the table is trimmed to a maximum entry count by least-recent use. Hit and miss
+counters are persisted alongside the entries so the hit rate survives restarts.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+RESULT_CACHE_PATH = Path(os.environ.get("SRED_RESULT_CACHE_PATH", Path(__file__).parent / ".cache" / "results.sqlite3"))
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get("SRED_RESULT_CACHE_TTL_HOURS", "168")) * 3600
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("SRED_RESULT_CACHE_MAX_ENTRIES", "500"))
+MODELFILE_PATH = Path(__file__).parent / "Modelfile"
+
+
+def modelfile_digest(path: Path = MODELFILE_PATH) -> str:
+    """SHA-256 of the Modelfile, or an empty string if it is missing."""
+    try:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return ""
+
+
+def result_cache_key(model: str, options: dict, modelfile_sha: str, messages: list[dict]) -> str:
+    """Returns the cache key for one generation request."""
+    prompt_hash = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+    key_material = {
+        'model': model,
+        'options': options,
+        'modelfile': modelfile_sha,
+        'prompt': prompt_hash,
+    }
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """SQLite-backed narrative cache with TTL and max-entry eviction. Safe to share across threads."""
+
+    def __init__(self, path: Path = RESULT_CACHE_PATH, ttl_seconds: float = RESULT_CACHE_TTL_SECONDS,
+                 max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _bump(self, name: str) -> None:
+        self._conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached narrative, or None if missing or expired."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT content, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._bump('misses')
+                return None
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            self._bump('hits')
+            return row[0]
+
+    def record_bypass(self) -> None:
+        """Counts a lookup skipped because the user asked to regenerate anyway."""
+        with self._lock, self._conn:
+            self._bump('bypasses')
+
+    def put(self, key: str, content: str) -> None:
+        """Stores a narrative, then drops expired entries and trims to max_entries."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, content, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, content, now, now)
+            )
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self) -> dict:
+        """Returns hit/miss/bypass counters, the hit rate and the current entry count."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'bypasses': counters.get('bypasses', 0),
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'entries': entries,
+        }
@@ -0,0 +1,205 @@
+"""
+BM25 retrieval over the SR&ED knowledge base.
+
+The corpus is the markdown in research/ (QA corpus, process entity model,
+example narratives, official references) plus the built-in knowledge base and
+few-shot examples from prompting.py. Documents are split into heading-scoped
+passages of bounded size, and a BM25 index over them is persisted to disk as
+JSON. The index is rebuilt only when the fingerprint of the source files (path,
+size, mtime) or the built-in text changes, so startup normally just loads it.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter
+from pathlib import Path
+
+from prompting import FEW_SHOT_EXAMPLES, KNOWLEDGE_BASE_CONTEXT
+
+RESEARCH_DIR = Path(__file__).parent / "research"
+RETRIEVAL_SOURCES = [
+    RESEARCH_DIR / "LLM_Knowledge_Base_Part_1_of_2_QA_Corpus.md",
+    RESEARCH_DIR / "LLM_Knowledge_Base_Part_2_of_2_Process_Entity_Model.md",
+    RESEARCH_DIR / "example_narratives.md",
+    RESEARCH_DIR / "official_references.md",
+]
+RETRIEVAL_INDEX_PATH = Path(os.environ.get("SRED_RETRIEVAL_INDEX_PATH", Path(__file__).parent / ".cache" / "retrieval_index.json"))
+
+# Bump when passage splitting or scoring changes so stale on-disk indexes are rebuilt
+INDEX_VERSION = 1
+PASSAGE_MAX_CHARS = 800
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+HEADING = re.compile(r"^#{1,6}\s+(.*)$")
+TOKEN = re.compile(r"[a-z0-9&]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how if in into is it its of on or that the their "
+    "this to was were what when which who will with you your not can do does".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased word tokens without stopwords."""
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def _pack_paragraphs(paragraphs: list[str], max_chars: int) -> list[str]:
+    passages = []
+    current = ""
+    for paragraph in paragraphs:
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            passages.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+def split_markdown(text: str, source: str, max_chars: int = PASSAGE_MAX_CHARS) -> list[dict]:
+    """Splits markdown into passages scoped to their nearest heading, each at most ~max_chars."""
+    sections = []
+    heading = ""
+    lines = []
+    for line in text.splitlines():
+        match = HEADING.match(line)
+        if match:
+            sections.append((heading, lines))
+            heading = match.group(1).strip("# ").strip()
+            lines = []
+        else:
+            lines.append(line)
+    sections.append((heading, lines))
+
+    passages = []
+    for heading, lines in sections:
+        paragraphs = [p.strip() for p in "\n".join(lines).split("\n\n")]
+        paragraphs = [p for p in paragraphs if p and p != "---"]
+        for body in _pack_paragraphs(paragraphs, max_chars):
+            passages.append({'source': source, 'heading': heading, 'text': body})
+    return passages
+
+
+def builtin_passages() -> list[dict]:
+    """Passages from the hard-coded knowledge base and few-shot examples in prompting.py."""
+    passages = []
+    for block in KNOWLEDGE_BASE_CONTEXT.strip().split("\n\n"):
+        if block.startswith("==="):
+            continue
+        heading = block.splitlines()[0].rstrip(":")
+        passages.append({'source': "built-in knowledge base", 'heading': heading, 'text': block})
+    for example in re.split(r"\n\n(?=EXAMPLE \d+:)", FEW_SHOT_EXAMPLES)[1:]:
+        heading = example.splitlines()[0]
+        passages.append({'source': "built-in examples", 'heading': heading, 'text': example})
+    return passages
+
+
+def corpus_fingerprint(sources: list[Path] = RETRIEVAL_SOURCES) -> str:
+    """Changes whenever a source file or the built-in text changes."""
+    digest = hashlib.sha256(f"v{INDEX_VERSION}".encode())
+    for path in sources:
+        try:
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        except FileNotFoundError:
+            digest.update(f"{path.name}:missing".encode())
+    digest.update(KNOWLEDGE_BASE_CONTEXT.encode())
+    digest.update(FEW_SHOT_EXAMPLES.encode())
+    return digest.hexdigest()
+
+
+def build_index(sources: list[Path] = RETRIEVAL_SOURCES) -> dict:
+    """Builds the passage list and BM25 statistics from the corpus."""
+    passages = builtin_passages()
+    for path in sources:
+        if path.exists():
+            passages.extend(split_markdown(path.read_text(encoding="utf-8"), path.name))
+
+    term_freqs = []
+    doc_freqs = Counter()
+    for passage in passages:
+        counts = Counter(tokenize(f"{passage['heading']}\n{passage['text']}"))
+        term_freqs.append(dict(counts))
+        doc_freqs.update(counts.keys())
+    lengths = [sum(tf.values()) for tf in term_freqs]
+    return {
+        'fingerprint': corpus_fingerprint(sources),
+        'passages': passages,
+        'term_freqs': term_freqs,
+        'doc_freqs': dict(doc_freqs),
+        'lengths': lengths,
+        'avg_length': sum(lengths) / len(lengths) if lengths else 0.0,
+    }
+
+
+class KnowledgeIndex:
+    """Disk-cached BM25 index that transparently rebuilds when the corpus changes."""
+
+    def __init__(self, sources: list[Path] = RETRIEVAL_SOURCES, index_path: Path = RETRIEVAL_INDEX_PATH):
+        self.sources = sources
+        self.index_path = Path(index_path)
+        self._lock = threading.Lock()
+        self._index = None
+        self._ensure_fresh()
+
+    def _ensure_fresh(self) -> dict:
+        fingerprint = corpus_fingerprint(self.sources)
+        with self._lock:
+            if self._index is not None and self._index['fingerprint'] == fingerprint:
+                return self._index
+            index = None
+            try:
+                index = json.loads(self.index_path.read_text(encoding="utf-8"))
+            except (FileNotFoundError, ValueError):
+                pass
+            if index is None or index.get('fingerprint') != fingerprint:
+                index = build_index(self.sources)
+                self.index_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.index_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+                tmp_path.write_text(json.dumps(index), encoding="utf-8")
+                os.replace(tmp_path, self.index_path)
+            self._index = index
+            return index
+
+    @property
+    def passage_count(self) -> int:
+        return len(self._ensure_fresh()['passages'])
+
+    def search(self, query: str, top_k: int) -> list[dict]:
+        """Returns up to top_k passages ranked by BM25 score against the query."""
+        index = self._ensure_fresh()
+        query_terms = set(tokenize(query))
+        passage_count = len(index['passages'])
+        scores = []
+        for i, term_freqs in enumerate(index['term_freqs']):
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * index['lengths'][i] / (index['avg_length'] or 1))
+            score = 0.0
+            for term in query_terms:
+                tf = term_freqs.get(term)
+                if not tf:
+                    continue
+                df = index['doc_freqs'][term]
+                idf = math.log(1 + (passage_count - df + 0.5) / (df + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + length_norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return [dict(index['passages'][i], score=score) for score, i in scores[:top_k]]
+
+    def reference_passages(self, query: str, top_k: int, max_chars: int) -> list[str]:
+        """Top passages formatted for the prompt, stopping before max_chars is exceeded."""
+        formatted = []
+        used = 0
+        for passage in self.search(query, top_k):
+            text = f"[{passage['source']} › {passage['heading']}]\n{passage['text']}" if passage['heading'] else f"[{passage['source']}]\n{passage['text']}"
+            if used + len(text) > max_chars:
+                continue
+            formatted.append(text)
+            used += len(text) + 2
+        return formatted
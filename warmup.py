@@ -0,0 +1,104 @@
+"""
+Startup timing and optional background warm-up.
+
+StartupTimer records once-per-process milestones (app imports done, first render
+finished) as seconds since the operating system started the process, so the
+Python and Streamlit server start-up before app.py runs is included. This is
+for tracking cold-start regressions. BackgroundWarmUp preloads the
+EasyOCR reader and loads the Ollama model on a daemon thread while the UI is
+already interactive, so the first real request doesn't pay for either.
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+
+def process_start_time() -> float:
+    """Wall-clock time at which this process was started, from /proc on Linux; falls back to now elsewhere."""
+    try:
+        # Fields after the parenthesised command name; starttime (field 22) is in clock ticks since boot
+        fields = Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()
+        boot_time = next(int(line.split()[1]) for line in Path("/proc/stat").read_text().splitlines() if line.startswith("btime "))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+PROCESS_STARTED = process_start_time()
+
+# Start the background warm-up by default (set SRED_WARMUP=0 to disable)
+WARMUP_DEFAULT = os.environ.get("SRED_WARMUP", "1") != "0"
+
+
+class StartupTimer:
+    """Seconds from process start to named milestones, each recorded once."""
+
+    def __init__(self, started: float = PROCESS_STARTED):
+        self.started = started
+        self.milestones: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, name: str) -> float:
+        with self._lock:
+            if name not in self.milestones:
+                self.milestones[name] = time.time() - self.started
+                print(f"[startup] {name}: {self.milestones[name]:.2f}s after process start")
+            return self.milestones[name]
+
+    def get(self, name: str) -> float | None:
+        return self.milestones.get(name)
+
+
+startup_timer = StartupTimer()
+
+
+class BackgroundWarmUp:
+    """
+    Loads the EasyOCR reader, and the model on every Ollama host, on daemon
+    threads in parallel since each Ollama server loads the model in its own process.
+    generators maps each host to a NarrativeGenerator for it; its step is named
+    "model <host>". status maps each step to "pending", "running", "ready" or
+    "failed: <reason>", and seconds records how long each finished step took.
+    """
+
+    def __init__(self, generators: dict):
+        self.actions = {"ocr": self._load_ocr, **{f"model {host}": generator.warm_up for host, generator in generators.items()}}
+        self.status = {step: "pending" for step in self.actions}
+        self.seconds: dict[str, float] = {}
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        for step, action in self.actions.items():
+            thread = threading.Thread(target=self._step, args=(step, action), name=f"warm-up-{step}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    @staticmethod
+    def _load_ocr() -> None:
+        from ocr_engine import get_reader
+
+        get_reader()
+
+    def _step(self, name: str, action) -> None:
+        self.status[name] = "running"
+        started = time.perf_counter()
+        try:
+            action()
+        except Exception as e:
+            self.status[name] = f"failed: {e}"
+        else:
+            self.status[name] = "ready"
+        self.seconds[name] = time.perf_counter() - started
+
+    def summary(self) -> str:
+        parts = []
+        for step in self.actions:
+            label = "OCR" if step == "ocr" else step
+            if step in self.seconds and self.status[step] == "ready":
+                parts.append(f"{label} ready in {self.seconds[step]:.1f}s")
+            else:
+                parts.append(f"{label} {self.status[step]}")
+        return ", ".join(parts)